@@ -1,9 +1,9 @@
 import requests
 
-from bs4 import BeautifulSoup
 from llama_index.core import Document
 
 from helpers import dprint
+from html_extractor import decode_html, extract_page
 
 
 class CustomWebReader:
@@ -15,21 +15,13 @@ class CustomWebReader:
                 response = requests.get(
                     url, timeout=10
                 )  # timesout in 10secs if its taking long
-                soup = BeautifulSoup(response.content, "html.parser")
-
-                # Remove scripts, styles, and ads
-                for script in soup(
-                    ["script", "style", "header", "footer", "nav", "aside"]
-                ):
-                    script.decompose()
-
-                # Extract text from the body
-                documents.append(
-                    Document(
-                        text=soup.get_text(separator="\n", strip=True),
-                        metadata={"url": url},
-                    )
+                # Extract the main text, dropping scripts, page chrome and ads. The
+                # body is decoded by its own charset, not requests' ISO-8859-1 guess.
+                html = decode_html(
+                    response.content, response.headers.get("Content-Type")
                 )
+                page = extract_page(html, url)
+                documents.append(Document(text=page["text"], metadata={"url": url}))
             except:
                 dprint("Failed loading contents from " + url)
 
@@ -0,0 +1,219 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from llama_index.core import Settings
+
+from helpers import dprint
+from search_handler import normalize_query
+from vector_store import get_embed_model_name, get_vector_store
+
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "answer_cache.db")
+
+# Seconds a finished recommendation is reused for similar requests
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", str(6 * 60 * 60)))
+
+# Cosine similarity between two requests' embeddings above which they get the same
+# recommendation
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+
+# Numbers in a request, like budgets, sizes and model numbers, which embeddings barely
+# tell apart but which change the right recommendation
+NUMBER_PATTERN = re.compile(r"\d+(?:[.,]\d+)*")
+
+
+def request_text(search_query, llm_prompt):
+    return f"{search_query}\n{llm_prompt}"
+
+
+def request_key(search_query, llm_prompt):
+    # Exact repeats of a request are found without embedding it
+    return f"{normalize_query(search_query)}\n{' '.join(llm_prompt.lower().split())}"
+
+
+def request_numbers(key):
+    # "$1,000" and "1000" are the same budget
+    return sorted(number.replace(",", "") for number in NUMBER_PATTERN.findall(key))
+
+
+class AnswerCache:
+    """
+    A persistent cache of finished recommendations, looked up by the similarity of the
+    (search query, LLM prompt) request that produced them.
+
+    Each answer remembers the content hash of every page it cites. Once the vector
+    store has seen one of those pages change, the answer is dropped instead of served.
+    """
+
+    def __init__(
+        self,
+        path=ANSWER_CACHE_PATH,
+        ttl=ANSWER_CACHE_TTL,
+        threshold=ANSWER_CACHE_THRESHOLD,
+    ):
+        self.ttl = ttl
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.time_saved = 0.0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+                id INTEGER PRIMARY KEY,
+                request_key TEXT NOT NULL,
+                model TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                response TEXT NOT NULL,
+                page_hashes TEXT NOT NULL,
+                duration REAL NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS answers_request_key ON answers (request_key)"
+        )
+        self._conn.commit()
+
+    def _find(self, search_query, llm_prompt):
+        # Returns the best cached answer for the request, as (id, response, page
+        # hashes, duration), or None
+        now = time.time()
+        model = get_embed_model_name()
+        key = request_key(search_query, llm_prompt)
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM answers WHERE created_at < ?", (now - self.ttl,)
+            )
+            self._conn.commit()
+            row = self._conn.execute(
+                "SELECT id, response, page_hashes, duration FROM answers "
+                "WHERE request_key = ? ORDER BY created_at DESC",
+                (key,),
+            ).fetchone()
+            if row is not None:
+                return row
+            rows = self._conn.execute(
+                "SELECT id, response, page_hashes, duration, embedding, request_key "
+                "FROM answers WHERE model = ?",
+                (model,),
+            ).fetchall()
+
+        # Only requests asking for the same numbers, e.g. "under $500" and not "under
+        # $800", can share an answer
+        numbers = request_numbers(key)
+        rows = [row for row in rows if request_numbers(row[5]) == numbers]
+        if not rows:
+            return None
+
+        query = np.asarray(
+            Settings.embed_model.get_query_embedding(
+                request_text(search_query, llm_prompt)
+            ),
+            dtype=np.float32,
+        )
+        embeddings = np.stack([np.frombuffer(row[4], dtype=np.float32) for row in rows])
+        scores = (
+            embeddings
+            @ query
+            / np.maximum(
+                np.linalg.norm(embeddings, axis=1) * np.linalg.norm(query), 1e-12
+            )
+        )
+        best = int(np.argmax(scores))
+        dprint(f"Closest cached answer has similarity {scores[best]:.3f}")
+        return rows[best][:4] if scores[best] >= self.threshold else None
+
+    def lookup(self, search_query, llm_prompt):
+        """
+        Returns the cached recommendation for a similar enough request, or None.
+        """
+        started_at = time.monotonic()
+        found = self._find(search_query, llm_prompt)
+        if found is not None:
+            answer_id, response, page_hashes, duration = found
+            page_hashes = json.loads(page_hashes)
+            current_hashes = get_vector_store().content_hashes(list(page_hashes))
+            if any(
+                current_hashes.get(url, digest) != digest
+                for url, digest in page_hashes.items()
+            ):
+                dprint("A page behind the cached answer has changed, dropping it")
+                with self._lock:
+                    self._conn.execute("DELETE FROM answers WHERE id = ?", (answer_id,))
+                    self._conn.commit()
+                found = None
+
+        lookup_time = time.monotonic() - started_at
+        with self._stats_lock:
+            if found is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.time_saved += max(0.0, duration - lookup_time)
+        dprint(
+            f"Answer cache {'hit' if found else 'miss'} in {lookup_time * 1000:.0f}ms "
+            f"({self.report()})"
+        )
+        return response if found is not None else None
+
+    def store(self, search_query, llm_prompt, response, source_urls, duration):
+        """
+        Caches a finished recommendation along with the pages it cites.
+
+        Args:
+            search_query (str): The web search query.
+            llm_prompt (str): The prompt the recommendation was generated for.
+            response (str): The recommendation, with its sources and buy links.
+            source_urls (list): The pages the recommendation cites.
+            duration (float): Seconds the recommendation took to produce.
+        """
+        embedding = Settings.embed_model.get_query_embedding(
+            request_text(search_query, llm_prompt)
+        )
+        page_hashes = get_vector_store().content_hashes(list(source_urls))
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO answers (request_key, model, embedding, response, "
+                "page_hashes, duration, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    request_key(search_query, llm_prompt),
+                    get_embed_model_name(),
+                    np.asarray(embedding, dtype=np.float32).tobytes(),
+                    response,
+                    json.dumps(page_hashes),
+                    duration,
+                    time.time(),
+                ),
+            )
+            self._conn.commit()
+
+    def report(self):
+        with self._stats_lock:
+            lookups = self.hits + self.misses
+            hit_rate = self.hits / lookups if lookups else 0.0
+            return (
+                f"{self.hits} hit(s), {self.misses} miss(es), {hit_rate:.0%} hit rate, "
+                f"{self.time_saved:.1f}s saved"
+            )
+
+
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache():
+    """
+    Returns the process-wide answer cache, opening it on first use.
+    """
+    global _answer_cache
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            _answer_cache = AnswerCache()
+        return _answer_cache
@@ -1,19 +1,35 @@
+import asyncio
 import json
 import os
+import time
 
 import chainlit as cl
 import openai
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
+from functools import partial
 from datetime import datetime
 from dotenv import load_dotenv
 from langsmith import traceable
 from langsmith.wrappers import wrap_openai
-from llama_index.core import Document, VectorStoreIndex
-
-from async_web_reader import AsyncWebReader
+from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.schema import QueryBundle
+
+from answer_cache import get_answer_cache
+from async_web_reader import AsyncWebReader, FetchMode, is_good_page
+from browser_pool import get_browser_pool
+from buy_links import BuyLinkIndex, parse_links_json
+from cassette import cassette_async_http_client, get_cassette, install_cassette
+from context_packer import RAG_CONTEXT_TOKENS, ContextPacker, count_tokens
+from deadline import Deadline
+from embedding_cache import embedding_stats, install_embedding_cache
 from helpers import dprint
+from hybrid_retriever import HybridRetriever
+from loop_monitor import loop_lag_monitor
 from prompts import FN_CALL_SYSTEM_PROMPT, FN_CALL_RAG_PROMPT, PURCHASING_LINKS_PROMPT
-from search_handler import search, Provider
+from search_handler import async_search
+from tool_arguments import StreamingArgumentParser
 from tool_calls import (
     PRODUCT_SEARCH_TOOL,
     ADD_TO_WISH_LIST_TOOL,
@@ -22,6 +38,8 @@ from tool_calls import (
     ADD_TO_ORDER_TOOL,
     GET_ORDERS_TOOL,
 )
+from url_filter import prepare_urls
+from vector_store import dedup_stats, get_vector_store
 from wishlist import add_to_wishlist, get_wishlist, remove_from_wishlist
 from orders import add_to_orders, get_orders
 
@@ -32,7 +50,54 @@ ENDPOINT_URL = os.getenv("OPENAI_ENDPOINT")
 MODEL = "gpt-4o"
 GEN_KWARGS = {"model": MODEL, "temperature": 0.3, "max_tokens": 500}
 
-client = wrap_openai(openai.AsyncClient(api_key=API_KEY, base_url=ENDPOINT_URL))
+# Seconds each product search has, end to end, before the best answer so far is shown
+SEARCH_DEADLINE = 20
+
+# Seconds allowed for the web search itself. Google is asked first, and DuckDuckGo is
+# asked too if Google hasn't answered within SEARCH_HEDGE_AFTER seconds or returned
+# fewer than SEARCH_MIN_RESULTS pages.
+SEARCH_TIMEOUT = 5
+SEARCH_HEDGE_AFTER = 1.5
+SEARCH_MIN_RESULTS = 10
+
+# Number of search results worth fetching, after dropping duplicates and useless sites
+PAGES_TO_FETCH = 10
+
+# Start answering once this many good pages have loaded, or once page loading has to
+# stop to leave RAG_TIME_RESERVE seconds for generating the recommendation
+PAGE_QUORUM = 6
+RAG_TIME_RESERVE = 8
+
+# Number of chunks retrieved as candidates for the recommendation's context, which is
+# packed into RAG_CONTEXT_TOKENS tokens, or a smaller budget when the deadline is close
+RAG_CANDIDATES = int(os.getenv("RAG_CANDIDATES", "8"))
+RAG_CONTEXT_TOKENS_SHORT_ON_TIME = RAG_CONTEXT_TOKENS // 2
+RAG_SHORT_ON_TIME = 6
+
+# Purchasing links are only looked up if at least this many seconds are left
+PRODUCT_LINKS_MIN_TIME = 4
+
+# Number of threads, shared by every chat session, that embed pages, build indexes and
+# look up purchasing links, so none of that blocks the event loop
+RAG_WORKERS = int(os.getenv("RAG_WORKERS", "4"))
+rag_executor = ThreadPoolExecutor(max_workers=RAG_WORKERS)
+
+OUT_OF_TIME_MSG = """Sorry, I ran out of time reviewing the search results for this one. 😓 \
+Here are the pages I was looking at, or you can ask me to try again."""
+
+CUT_SHORT_MSG = """_⏱️ I ran out of time before finishing this answer, so it was cut short. You can ask me to try again for the full recommendation._"""
+
+# Record or replay OpenAI, search and page fetch calls if CASSETTE_MODE is set, and
+# reuse the embeddings of chunks seen before instead of sending them again
+install_cassette()
+install_embedding_cache()
+client = wrap_openai(
+    openai.AsyncClient(
+        api_key=API_KEY,
+        base_url=ENDPOINT_URL,
+        http_client=cassette_async_http_client(),
+    )
+)
 
 WELCOME_MSG = """\
 Hi! 👋 I'm here to help you find the best products out there. \
@@ -72,35 +137,52 @@ async def generate_response(client, message_history, gen_kwargs):
         **gen_kwargs,
     )
     response = {}
-    async for part in stream:
-        new_delta = part.choices[0].delta
-        if new_delta.role is not None:
-            response["role"] = new_delta.role
-        if (
-            new_delta.tool_calls is not None
-            and len(new_delta.tool_calls) > 0
-            and new_delta.tool_calls[0].function is not None
-        ):
-            fn_call = new_delta.tool_calls[0].function
-            if fn_call.name:
-                response["func_call"] = {"name": fn_call.name}
-            if fn_call.arguments:
-                if "arguments" not in response["func_call"]:
-                    response["func_call"]["arguments"] = ""
-                response["func_call"]["arguments"] += fn_call.arguments
-        else:
-            new_content = new_delta.content or ""
-            if "content" not in response:
-                response["content"] = ""
-            response["content"] += new_content
-            if len(new_content):
-                if ui_response_message is None:
-                    ui_response_message = cl.Message(content="")
-                    await ui_response_message.send()
-                await ui_response_message.stream_token(new_content)
-
-    if ui_response_message is not None:
-        await ui_response_message.update()
+    argument_parser = None
+    try:
+        async for part in stream:
+            new_delta = part.choices[0].delta
+            if new_delta.role is not None:
+                response["role"] = new_delta.role
+            if (
+                new_delta.tool_calls is not None
+                and len(new_delta.tool_calls) > 0
+                and new_delta.tool_calls[0].function is not None
+            ):
+                fn_call = new_delta.tool_calls[0].function
+                if fn_call.name:
+                    response["func_call"] = {"name": fn_call.name}
+                    if fn_call.name == "product_search":
+                        argument_parser = StreamingArgumentParser()
+                if fn_call.arguments:
+                    if "arguments" not in response["func_call"]:
+                        response["func_call"]["arguments"] = ""
+                    response["func_call"]["arguments"] += fn_call.arguments
+                    # Start searching as soon as the search query is complete, while the
+                    # LLM prompt is still streaming
+                    if argument_parser is not None and "page_search" not in response:
+                        fields = argument_parser.feed(fn_call.arguments)
+                        if "google_search_query" in fields:
+                            response["page_search"] = PageSearch(
+                                fields["google_search_query"]
+                            )
+            else:
+                new_content = new_delta.content or ""
+                if "content" not in response:
+                    response["content"] = ""
+                response["content"] += new_content
+                if len(new_content):
+                    if ui_response_message is None:
+                        ui_response_message = cl.Message(content="")
+                        await ui_response_message.send()
+                    await ui_response_message.stream_token(new_content)
+
+        if ui_response_message is not None:
+            await ui_response_message.update()
+    except BaseException:
+        # A search started from the streamed query isn't handed back to the caller
+        if "page_search" in response:
+            response["page_search"].discard()
+        raise
 
     return response
 
@@ -114,101 +196,376 @@ def get_sources_list(source_urls):
     return sources_list
 
 
-def get_product_links_list(webpages, source_urls, recommendation_blurb):
+def format_product_links(product_links):
+    return "\n".join(
+        [f"• {product_name}: {link}\n" for (product_name, link) in product_links]
+    )
+
+
+def index_buy_links(webpages, source_urls):
     """
-    Extracts and formats the purchasing links from the given product recommendation blurb.
+    Indexes the store links found while parsing the source pages, then the rest of the
+    loaded pages, so they can be matched as soon as the recommendation is written.
     """
-    product_links_list = ""
-    docs = [
-        Document(text=page["html"]) for page in webpages if page["url"] in source_urls
-    ]
-    if not len(docs):
-        return product_links_list
+    source_pages = [page for page in webpages if page["url"] in source_urls]
+    return [BuyLinkIndex(pages) for pages in (source_pages, webpages)]
+
+
+def get_product_links_list(
+    webpages, source_urls, recommendation_blurb, buy_link_indexes=None
+):
+    """
+    Extracts and formats the purchasing links from the given product recommendation blurb.
 
-    index = VectorStoreIndex.from_documents(docs)
+    The products named in the blurb are matched against the store links found while
+    parsing the source pages, then the rest of the loaded pages. The LLM is only asked
+    to find the links if none of them match.
+
+    Args:
+        buy_link_indexes (list): The indexes from index_buy_links, if already built.
+    """
+    source_pages = [page for page in webpages if page["url"] in source_urls]
+    if buy_link_indexes is None:
+        buy_link_indexes = index_buy_links(webpages, source_urls)
+    for buy_link_index in buy_link_indexes:
+        product_links = buy_link_index.match(recommendation_blurb)
+        if product_links:
+            dprint(f"Matched purchasing links: {product_links}")
+            return format_product_links(product_links)
+
+    if not len(source_pages):
+        return ""
+
+    # Only pages whose links changed since they were last seen are embedded again
+    vector_store = get_vector_store()
+    for page in source_pages:
+        links_text = "\n".join(
+            f"{anchor_text}: {href}" for anchor_text, href in page["links"]
+        )
+        vector_store.upsert(page["url"], links_text, collection="links")
+    index = vector_store.as_index(
+        [page["url"] for page in source_pages], collection="links"
+    )
     query_engine = index.as_query_engine()
     prompt = PURCHASING_LINKS_PROMPT.format(recommendation_blurb=recommendation_blurb)
     product_links_rag_response = str(query_engine.query(prompt).response)
     dprint(f"product_links_rag_response: {product_links_rag_response}")
-    if not product_links_rag_response:
-        return product_links_list
+    return format_product_links(parse_links_json(product_links_rag_response))
 
-    product_links_result = json.loads(product_links_rag_response)
-    return "\n".join(
-        [
-            f"• {product_name}: {link}\n"
-            for (product_name, link) in json.loads(product_links_rag_response)
-            if len(link)
-        ]
+
+def cache_answer(search_query, llm_prompt, response, source_urls, duration):
+    try:
+        get_answer_cache().store(
+            search_query, llm_prompt, response, source_urls, duration
+        )
+    except Exception as e:
+        dprint(f"Couldn't cache the answer: {e}")
+
+
+async def load_and_index_pages(urls, deadline):
+    """
+    Fetches the search result pages and upserts each one into the persistent vector
+    store as soon as it loads, so embedding overlaps with the slower fetches. Pages
+    already embedded by an earlier search are reused as is. Stops once PAGE_QUORUM good
+    pages have arrived or only RAG_TIME_RESERVE seconds are left before the deadline,
+    and cancels the remaining fetches.
+
+    Args:
+        urls (list): The URLs of the search result pages.
+        deadline (Deadline): The time budget of the current search.
+
+    Returns:
+        tuple: The loaded pages and their stored chunks, with embeddings.
+    """
+    loop = asyncio.get_running_loop()
+    reader = AsyncWebReader(fetch_mode=FetchMode.Tiered)
+    vector_store = get_vector_store()
+    webpages = []
+    good_pages = 0
+
+    timeout = deadline.remaining(reserve=RAG_TIME_RESERVE)
+    async with aclosing(reader.iter_data(urls, timeout=timeout)) as pages:
+        async for page in pages:
+            webpages.append(page)
+            await loop.run_in_executor(
+                rag_executor, vector_store.upsert, page["url"], page["text"]
+            )
+            if is_good_page(page):
+                good_pages += 1
+            if good_pages >= PAGE_QUORUM:
+                dprint(f"Got {good_pages} good pages, skipping the rest...")
+                break
+
+    dprint(f"Fetch scheduler stats:\n{reader.scheduler.report()}")
+    dprint(f"Embedding cache stats: {embedding_stats.report()}")
+    dprint(f"Near-duplicate chunk stats: {dedup_stats.report()}")
+
+    # Retrieve only from the pages this search returned
+    nodes = await loop.run_in_executor(
+        rag_executor, vector_store.get_nodes, [page["url"] for page in webpages]
     )
+    return webpages, nodes
 
 
-@traceable
-async def search_and_process(search_query, llm_prompt, ui_status_message):
+async def search_pages(search_query, deadline, ui_status_message=None):
     """
-    Performs a web search based on the given query, processes the search results,
-    and generates a response using RAG.
+    Searches the web for the query, then loads and indexes the result pages.
 
     Args:
         search_query (str): The search query to be used for web search.
-        llm_prompt (str): The prompt to be used for the language model.
-        ui_status_message (object): An object used to update the UI with status messages.
+        deadline (Deadline): The time budget of the current search.
+        ui_status_message (object): Updated with the search's progress, if given.
 
     Returns:
-        None: This function updates the UI status message with the final RAG response.
+        tuple: The loaded pages and their stored chunks, with embeddings.
     """
-    ui_status_message.content = f'🔍 Searching the web for `"{search_query}"`...'
-    await ui_status_message.update()
+    try:
+        search_results = await asyncio.wait_for(
+            async_search(
+                search_query,
+                max_results=15,
+                hedge_after=SEARCH_HEDGE_AFTER,
+                min_results=SEARCH_MIN_RESULTS,
+            ),
+            timeout=deadline.cap(SEARCH_TIMEOUT),
+        )
+    except asyncio.TimeoutError:
+        dprint(f"Web search timed out after {deadline.elapsed():.1f}s")
+        search_results = []
 
-    search_results = search(search_query=search_query, max_results=15)
-    ui_status_message.content = f"👀 Reviewing {len(search_results)} results closely for the best recommendations..."
-    await ui_status_message.update()
+    # Only fetch the pages likely to have useful review text
+    search_results = prepare_urls(search_results, max_urls=PAGES_TO_FETCH)
+    if ui_status_message is not None:
+        ui_status_message.content = f"👀 Reviewing {len(search_results)} results closely for the best recommendations..."
+        await ui_status_message.update()
 
-    # Load search result pages
+    # Load search result pages, indexing each one as soon as it arrives
     try:
-        reader = AsyncWebReader()
-        webpages = await reader.load_data(urls=search_results)
+        return await load_and_index_pages(search_results, deadline)
     except Exception as e:
         dprint(f"Error loading data from URLs: {e}")
-        webpages = []
+        return [], []
 
-    # Generate product recommendations
-    docs = [
-        Document(text=page["text"], metadata={"url": page["url"]}) for page in webpages
-    ]
-    index = VectorStoreIndex.from_documents(docs)
-    query_engine = index.as_query_engine()
+
+class PageSearch:
+    """
+    A web search and page load started speculatively, as soon as the product_search
+    call's search query has streamed in. The search's deadline starts with it.
+    """
+
+    def __init__(self, search_query):
+        self.search_query = search_query
+        self.deadline = Deadline(SEARCH_DEADLINE)
+        self.task = asyncio.create_task(search_pages(search_query, self.deadline))
+        dprint(f'Started searching for "{search_query}" ahead of the LLM prompt')
+
+    def discard(self):
+        if not self.task.done():
+            self.task.cancel()
+
+
+async def stream_rag_response(rag_results, ui_message, started_at):
+    """
+    Streams the recommendation into the UI message token by token, replacing the
+    status shown there.
+
+    Returns:
+        float: The seconds from started_at until the first token arrived, or None if
+            the recommendation had no tokens.
+    """
+    # The status stays on screen until the first token replaces it
+    ui_message.content = ""
+    first_token_time = None
+    async for token in rag_results.async_response_gen():
+        if first_token_time is None:
+            first_token_time = time.monotonic() - started_at
+        await ui_message.stream_token(token)
+    return first_token_time
+
+
+@traceable
+async def search_and_process(
+    search_query, llm_prompt, ui_status_message, page_search=None
+):
+    """
+    Performs a web search based on the given query, processes the search results,
+    and generates a response using RAG.
+
+    Args:
+        search_query (str): The search query to be used for web search.
+        llm_prompt (str): The prompt to be used for the language model.
+        ui_status_message (object): An object used to update the UI with status messages.
+        page_search (PageSearch): The search already started for the same query, if any.
+
+    Returns:
+        None: This function updates the UI status message with the final RAG response.
+    """
+    deadline = page_search.deadline if page_search else Deadline(SEARCH_DEADLINE)
+    loop = asyncio.get_running_loop()
+    # Recordings must hold the whole pipeline, so the answer cache is bypassed with a
+    # cassette
+    answer_cache = get_answer_cache() if get_cassette() is None else None
+
+    # Serve the recommendation made for an earlier, nearly identical request
+    cached_response = None
+    if answer_cache is not None:
+        try:
+            cached_response = await loop.run_in_executor(
+                rag_executor, answer_cache.lookup, search_query, llm_prompt
+            )
+        except Exception as e:
+            dprint(f"Answer cache lookup failed: {e}")
+    if cached_response is not None:
+        if page_search is not None:
+            page_search.discard()
+        ui_status_message.content = cached_response
+        await ui_status_message.update()
+        return cached_response
+
+    if page_search is not None:
+        # Already searching since the search query streamed in
+        ui_status_message.content = (
+            "👀 Reviewing the results closely for the best recommendations..."
+        )
+        await ui_status_message.update()
+        webpages, nodes = await page_search.task
+    else:
+        ui_status_message.content = f'🔍 Searching the web for `"{search_query}"`...'
+        await ui_status_message.update()
+        webpages, nodes = await search_pages(search_query, deadline, ui_status_message)
+
+    # Generate product recommendations, packing less context if time is short
+    packer = ContextPacker(
+        token_budget=(
+            RAG_CONTEXT_TOKENS
+            if deadline.remaining() > RAG_SHORT_ON_TIME
+            else RAG_CONTEXT_TOKENS_SHORT_ON_TIME
+        )
+    )
+    # Chunks are ranked by keyword (BM25) and embedding similarity to the user's
+    # request, so exact product names, model numbers and prices aren't missed
+    retriever = await loop.run_in_executor(
+        rag_executor, partial(HybridRetriever, nodes, similarity_top_k=RAG_CANDIDATES)
+    )
+    query_engine = RetrieverQueryEngine.from_args(
+        retriever, node_postprocessors=[packer], streaming=True
+    )
     rag_prompt = FN_CALL_RAG_PROMPT.format(llm_prompt=llm_prompt)
     dprint(f"rag_prompt: {rag_prompt}")
-    rag_results = query_engine.query(rag_prompt)
-    rag_response = str(rag_results.response)
-    dprint(f"rag_response: {rag_response}")
-    dprint(f"rag_results.metadata: {rag_results.metadata}")
-
-    # Add sources for product recommendations
-    ui_status_message.content = "📚 Citing my sources to give credit where it's due..."
-    await ui_status_message.update()
+    started_at = time.monotonic()
+    try:
+        # Returns once the chunks are retrieved and the answer starts streaming
+        rag_results = await asyncio.wait_for(
+            query_engine.aquery(
+                QueryBundle(rag_prompt, custom_embedding_strs=[llm_prompt])
+            ),
+            timeout=deadline.remaining(),
+        )
+    except asyncio.TimeoutError:
+        dprint(f"RAG query timed out after {deadline.elapsed():.1f}s")
+        sources_list = get_sources_list([page["url"] for page in webpages])
+        recommendation_response = f"{OUT_OF_TIME_MSG}\n\n{sources_list}"
+        ui_status_message.content = recommendation_response
+        await ui_status_message.update()
+        return recommendation_response
+    rag_metadata = rag_results.metadata or {}
+    dprint(f"rag_results.metadata: {rag_metadata}")
+
+    # The sources are known from the retrieved chunks, so they and the purchasing
+    # links are prepared while the recommendation streams. Chunks syndicated across
+    # several pages cite every one of them.
     source_urls = {
-        rag_results.metadata[source]["url"]
-        for source in rag_results.metadata
-        if rag_results.metadata[source]["url"]
+        url
+        for source in rag_metadata
+        for url in rag_metadata[source].get("urls", [rag_metadata[source]["url"]])
+        if url
     }
     sources_list = get_sources_list(source_urls)
+    buy_link_indexes = loop.run_in_executor(
+        rag_executor, index_buy_links, webpages, source_urls
+    )
 
-    # Find purchasing links for product recommendations
-    ui_status_message.content = "🎣 Fetching link(s) to buy product(s)..."
-    await ui_status_message.update()
-    product_links_list = get_product_links_list(webpages, source_urls, rag_response)
+    # Answers missing a stage aren't cached, so later requests get a complete one
+    complete = True
+    try:
+        first_token_time = await asyncio.wait_for(
+            stream_rag_response(rag_results, ui_status_message, started_at),
+            timeout=deadline.remaining(),
+        )
+        rag_response = ui_status_message.content or "Empty Response"
+    except asyncio.TimeoutError:
+        # Keep whatever was streamed before the deadline, marked as cut short
+        dprint(f"Recommendation stream timed out after {deadline.elapsed():.1f}s")
+        first_token_time = None
+        complete = False
+        rag_response = (
+            f"{ui_status_message.content}\n\n{CUT_SHORT_MSG}"
+            if ui_status_message.content
+            else OUT_OF_TIME_MSG
+        )
+    dprint(
+        f"Recommendation prompt: ~{packer.packed_tokens + count_tokens(rag_prompt)} "
+        f"token(s), {packer.packed_tokens} of them packed context from "
+        f"{len(rag_metadata)} chunk(s); first token after "
+        + (f"{first_token_time:.2f}s" if first_token_time is not None else "n/a")
+    )
+    dprint(f"rag_response: {rag_response}")
 
     recommendation_response = (
         f"{rag_response}\n\n\n**🔗 Review Source(s):**\n{sources_list}"
     )
+
+    # Find purchasing links for product recommendations, unless time is running out
+    product_links_list = ""
+    if deadline.remaining() >= PRODUCT_LINKS_MIN_TIME:
+        ui_status_message.content = (
+            f"{recommendation_response}\n\n\n🎣 Fetching link(s) to buy product(s)..."
+        )
+        await ui_status_message.update()
+        try:
+            buy_link_indexes = await asyncio.wait_for(
+                buy_link_indexes, timeout=deadline.remaining()
+            )
+            product_links_list = await asyncio.wait_for(
+                loop.run_in_executor(
+                    rag_executor,
+                    get_product_links_list,
+                    webpages,
+                    source_urls,
+                    rag_response,
+                    buy_link_indexes,
+                ),
+                timeout=deadline.remaining(),
+            )
+        except asyncio.TimeoutError:
+            dprint("Purchasing link lookup timed out, skipping it")
+            complete = False
+    else:
+        dprint("Skipping purchasing links, the search is almost out of time")
+        complete = False
+
     if len(product_links_list):
         recommendation_response += f"\n\n\n**🛍️ Link(s) to Buy:**\n{product_links_list}"
-
     ui_status_message.content = recommendation_response
     await ui_status_message.update()
 
+    dprint(f"Product search took {deadline.elapsed():.1f}s of {deadline.budget}s")
+    dprint(f"Event loop health: {loop_lag_monitor.report()}")
+
+    # Cache the recommendation for similar requests, once it has sources to check for
+    # changes against and every stage finished within the deadline
+    complete = complete and not deadline.expired()
+    if source_urls and complete and answer_cache is not None:
+        loop.run_in_executor(
+            rag_executor,
+            cache_answer,
+            search_query,
+            llm_prompt,
+            recommendation_response,
+            source_urls,
+            deadline.elapsed(),
+        )
+
     return recommendation_response
 
 
@@ -224,6 +581,13 @@ async def handle_chat_start():
     message_history = [{"role": "system", "content": system_prompt}]
     cl.user_session.set("message_history", message_history)
 
+    # Warm up the shared browser pool in the background so the first search doesn't
+    # have to wait for Chrome to start
+    asyncio.get_running_loop().run_in_executor(None, get_browser_pool().warm)
+
+    # Watch for anything blocking the event loop shared by every session
+    loop_lag_monitor.start()
+
 
 @traceable
 @cl.on_message
@@ -235,25 +599,42 @@ async def handle_message(message):
     message_history.append({"role": "user", "content": query})
 
     response = await generate_response(client, message_history, GEN_KWARGS)
+    page_search = response.pop("page_search", None)
     dprint(f"LLM Response: {response}")
 
     if response.get("func_call") and response["func_call"]["name"] == "product_search":
-        arguments = json.loads(response["func_call"]["arguments"])
-        search_query = arguments["google_search_query"]
-        llm_prompt = arguments["llm_prompt"]
-        message_history.append(
-            {
-                "role": "assistant",
-                "content": f'Calling product_search("{search_query}", "{llm_prompt}")',
-            }
-        )
+        # Whatever fails before the search is used, e.g. malformed arguments, a missing
+        # argument or a cancelled request, must not leave it loading pages
+        try:
+            arguments = json.loads(response["func_call"]["arguments"])
+            search_query = arguments["google_search_query"]
+            llm_prompt = arguments["llm_prompt"]
+            # The search started while the arguments streamed is only used if the final
+            # arguments ask for the same search
+            if page_search is not None and page_search.search_query != search_query:
+                dprint(
+                    f'Discarding the search for "{page_search.search_query}", the final '
+                    f'query is "{search_query}"'
+                )
+                page_search.discard()
+                page_search = None
+            message_history.append(
+                {
+                    "role": "assistant",
+                    "content": f'Calling product_search("{search_query}", "{llm_prompt}")',
+                }
+            )
 
-        status_message = await cl.Message(content="").send()
-        search_response = await search_and_process(
-            search_query, llm_prompt, status_message
-        )
-        # Update the message history with the RAG response
-        message_history.append({"role": "assistant", "content": search_response})
+            status_message = await cl.Message(content="").send()
+            search_response = await search_and_process(
+                search_query, llm_prompt, status_message, page_search
+            )
+            # Update the message history with the RAG response
+            message_history.append({"role": "assistant", "content": search_response})
+        except BaseException:
+            if page_search is not None:
+                page_search.discard()
+            raise
     elif (
         response.get("func_call") and response["func_call"]["name"] == "add_to_wishlist"
     ):
@@ -9,11 +9,15 @@ from search_handler import search, Provider
 from llama_index.readers.web import BeautifulSoupWebReader
 from llama_index.core import VectorStoreIndex
 from CustomWebReader import CustomWebReader
+from embedding_cache import install_embedding_cache
 
 API_KEY = os.getenv("OPENAI_API_KEY")
 ENDPOINT_URL = os.getenv("OPENAI_ENDPOINT")
 MODEL = "gpt-4o-2024-08-06"
 
+# Reuse the embeddings of chunks seen before instead of sending them again
+install_embedding_cache()
+
 client = wrap_openai(openai.AsyncClient(api_key=API_KEY, base_url=ENDPOINT_URL))
 
 
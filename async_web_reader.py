@@ -1,32 +1,163 @@
+import aiohttp
 import asyncio
+import threading
 import time
 
-from bs4 import BeautifulSoup
 from concurrent.futures import ThreadPoolExecutor
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
+from contextlib import aclosing
+from enum import Enum
+from functools import partial
 
-from helpers import dprint
+from browser_pool import get_browser_pool
+from cassette import get_cassette
+from fetch_scheduler import THROTTLE_STATUSES, get_fetch_scheduler
+from helpers import dprint, get_domain
+from html_extractor import extract_page_async
+from page_cache import get_page_cache, get_validators
+from page_readiness import wait_for_page_ready
+from url_filter import get_domain_yields
 
+FetchMode = Enum("FetchMode", "Browser Tiered")
 
-class AsyncWebReader:
-    def __init__(self, max_workers=10):
-        # Setup Selenium options
-        chrome_options = Options()
-        chrome_options.add_argument("--headless")  # Run in headless mode
-        chrome_options.add_argument("--disable-gpu")  # Disable GPU
-        chrome_options.add_argument("--no-sandbox")  # Bypass OS security model
-        chrome_options.add_argument(
-            "--disable-dev-shm-usage"
-        )  # Overcome limited resource problems
-
-        # Customize headers to avoid bot detection
-        chrome_options.add_argument(
-            "user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+HTTP_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.9",
+}
+
+# Seconds allowed for the plain HTTP attempt before falling back to the browser
+HTTP_TIMEOUT = 10
+
+# Statuses after which the page isn't rendered in the browser either: the host wants
+# us to back off, or the page doesn't exist
+NO_RENDER_STATUSES = (*THROTTLE_STATUSES, 404, 410)
+
+# Pages with less visible text than this are assumed to be rendered by JavaScript
+MIN_TEXT_LENGTH = 500
+
+# Markers of bot walls and JavaScript challenges served instead of the real page
+CHALLENGE_MARKERS = [
+    "cf-browser-verification",
+    "challenge-platform",
+    "cf_chl_opt",
+    "just a moment...",
+    "attention required! | cloudflare",
+    "_incapsula_resource",
+    "px-captcha",
+    "captcha-delivery.com",
+    "are you a robot",
+]
+
+# A domain's HTTP attempt is skipped once this many of its pages in a row needed a
+# browser, until BROWSER_DOMAIN_TTL seconds after the last one
+BROWSER_DOMAIN_MIN_HITS = 2
+BROWSER_DOMAIN_TTL = 60 * 60
+
+
+class PageRefused(Exception):
+    """
+    Raised when a page's host answers with one of NO_RENDER_STATUSES, so the page is
+    neither rendered nor counted against its domain's yield.
+    """
+
+
+class BrowserDomains:
+    """
+    Remembers the domains whose pages keep needing a full browser render, so their
+    HTTP attempt can be skipped. A single short page, like a teaser or a soft 404,
+    doesn't pin a domain, and pinned domains are tried over HTTP again after a while.
+    """
+
+    def __init__(self, min_hits=BROWSER_DOMAIN_MIN_HITS, ttl=BROWSER_DOMAIN_TTL):
+        self.min_hits = min_hits
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._hits = {}
+
+    def __contains__(self, domain):
+        with self._lock:
+            entry = self._hits.get(domain)
+            if entry is None:
+                return False
+            hits, last_hit = entry
+            if time.monotonic() - last_hit >= self.ttl:
+                del self._hits[domain]
+                return False
+            return hits >= self.min_hits
+
+    def add(self, domain):
+        """
+        Records that one of the domain's pages needed a browser.
+        """
+        now = time.monotonic()
+        with self._lock:
+            hits, last_hit = self._hits.get(domain, (0, now))
+            if now - last_hit >= self.ttl:
+                hits = 0
+            self._hits[domain] = (hits + 1, now)
+
+    def discard(self, domain):
+        """
+        Forgets the domain's hits after one of its pages loaded fine over HTTP.
+        """
+        with self._lock:
+            self._hits.pop(domain, None)
+
+
+browser_domains = BrowserDomains()
+
+_http_session = None
+
+
+def needs_browser(html, text):
+    """
+    Guesses whether a page fetched over plain HTTP needs JavaScript to show its content.
+    """
+    if len(text) < MIN_TEXT_LENGTH:
+        return True
+
+    lowered_html = html.lower()
+    if any(marker in lowered_html for marker in CHALLENGE_MARKERS):
+        return True
+
+    # A noscript shell tells the user to turn on JavaScript instead of showing content
+    if "<noscript" in lowered_html and "enable javascript" in text.lower():
+        return True
+
+    return False
+
+
+def is_good_page(page):
+    """
+    Returns whether the page has enough text to be worth using for recommendations.
+    """
+    return len(page["text"]) >= MIN_TEXT_LENGTH
+
+
+def get_http_session():
+    """
+    Returns the shared aiohttp session, whose connection pool is reused across fetches.
+    """
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            headers=HTTP_HEADERS,
+            connector=aiohttp.TCPConnector(limit=50, limit_per_host=4),
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
         )
+    return _http_session
 
-        # Set executable path for Selenium
-        self.driver_options = chrome_options
+
+class AsyncWebReader:
+    def __init__(
+        self,
+        max_workers=10,
+        browser_pool=None,
+        fetch_mode=FetchMode.Browser,
+        use_cache=True,
+    ):
+        # Share the process-wide pool of warm Chrome drivers across all readers
+        self.browser_pool = browser_pool or get_browser_pool()
 
         # Create a thread pool executor with a specified number of workers
         self.executor = ThreadPoolExecutor(max_workers=max_workers)
@@ -34,63 +165,230 @@ class AsyncWebReader:
         # Timeout (in seconds) for AsyncWebReader to execute fetching contents
         self.timeout = 30
 
-    def _fetch_content(self, url):
+        # Whether to try a plain HTTP request before rendering pages in the browser
+        self.fetch_mode = fetch_mode
+
+        # Share the process-wide fetch scheduler, which caps concurrency per host and
+        # across every chat session
+        self.scheduler = get_fetch_scheduler()
+
+        # Record or replay page fetches if a cassette is in use
+        self.cassette = get_cassette()
+
+        # Share the process-wide on-disk cache of extracted page content. Recordings
+        # must hold every page, so the cache is bypassed with a cassette.
+        use_cache = use_cache and self.cassette is None
+        self.page_cache = get_page_cache() if use_cache else None
+
+    def _fetch_content(self, url, cancelled=None):
         dprint(f"Fetching content from {url}...")
 
-        # Initialize WebDriver (Chrome)
-        driver = webdriver.Chrome(options=self.driver_options)
-        driver.get(url)
+        # Render the page on a pooled WebDriver (Chrome), giving the driver back early
+        # if the page stops being wanted
+        def render():
+            return self.browser_pool.render(
+                url,
+                wait_fn=lambda driver: wait_for_page_ready(driver, url, cancelled),
+                cancelled=cancelled,
+            )
 
-        # Wait for the page to fully load
-        time.sleep(1.5)  # Adjust this wait time based on the website
+        if self.cassette is not None:
+            return self.cassette.call("rendered_page", [url], render)
+        return render()
 
+    async def _parse_content(self, page_source, url):
         dprint(f"Parsing content from {url}...")
 
-        # Use BeautifulSoup to parse the page content
-        soup = BeautifulSoup(driver.page_source, "html.parser")
+        # Extract the main text, links and prices on the parsing process pool, dropping
+        # page chrome and ads
+        page = await extract_page_async(page_source, url)
 
-        # Close WebDriver after getting the page source
-        driver.quit()
+        dprint(f"Done scraping content from {url}...")
+        return page
 
-        # Remove unwanted elements
-        for element in soup(["script", "style", "header", "footer", "nav", "aside"]):
-            element.decompose()
+    async def _fetch_html(self, url, cached=None):
+        # Fetch the raw page over plain HTTP, revalidating the stale cached copy if there
+        # is one. Returns the status, HTML and cache validators, with no HTML if the
+        # status isn't 200, or None if the request fails.
+        if self.cassette is not None:
+            return await self.cassette.acall(
+                "http_page", [url], lambda: self._fetch_html_live(url)
+            )
+        return await self._fetch_html_live(url, cached)
 
-        dprint(f"Done scraping content from {url}...")
+    async def _fetch_html_live(self, url, cached=None):
+        headers = cached.conditional_headers() if cached is not None else {}
+        try:
+            async with get_http_session().get(url, headers=headers) as response:
+                self.scheduler.record_status(
+                    url, response.status, response.headers.get("Retry-After")
+                )
+                validators = get_validators(response.headers)
+                if response.status == 304 and cached is not None:
+                    return response.status, None, validators
+                if response.status != 200:
+                    dprint(f"HTTP fetch of {url} returned {response.status}")
+                    return response.status, None, validators
+                if "html" not in response.headers.get("Content-Type", "html"):
+                    dprint(f"HTTP fetch of {url} did not return an HTML page")
+                    return None
+                return response.status, await response.text(), validators
+        except Exception as e:
+            dprint(f"HTTP fetch of {url} failed: {e}")
+            return None
 
-        # Return the cleaned text content
-        return {
-            "text": soup.get_text(separator="\n", strip=True),
-            "html": soup.prettify(),
-            "url": url,
-        }
+    async def _cache_call(self, method, *args, **kwargs):
+        # The page cache blocks on SQLite, so it's kept off the event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, partial(method, *args, **kwargs))
 
-    async def _fetch_content_async(self, url):
-        # Run blocking content fetch in the custom thread pool executor with timeout
+    async def _fetch_content_rendered(self, url, cancelled):
         loop = asyncio.get_event_loop()
+        render = loop.run_in_executor(
+            self.executor, self._fetch_content, url, cancelled
+        )
+        try:
+            page_source = await asyncio.shield(render)
+        except asyncio.CancelledError:
+            # Cancelling the task doesn't stop the render thread, so tell it to stop and
+            # keep holding the fetch slot until it has given its driver back
+            cancelled.set()
+            try:
+                await render
+            except Exception:
+                pass
+            raise
+        page = await self._parse_content(page_source, url)
+        # Empty pages and bot walls aren't cached, so the next search tries again
+        if self.page_cache is not None and not needs_browser(page_source, page["text"]):
+            await self._cache_call(self.page_cache.put, url, page)
+        return page
+
+    async def _fetch_content_tiered(self, url, cancelled, cached=None):
+        domain = get_domain(url)
+
+        if domain not in browser_domains:
+            result = await self._fetch_html(url, cached)
+            status, html, validators = result if result is not None else (None,) * 3
+            if status == 304 and cached is not None:
+                dprint(f"{url} hasn't changed, using the cached copy")
+                await self._cache_call(self.page_cache.refresh, url)
+                return cached.page
+            if status in NO_RENDER_STATUSES:
+                raise PageRefused(f"HTTP fetch of {url} returned {status}")
 
-        # Use futures to add a timeout for the content fetching
+            if html is not None:
+                page = await self._parse_content(html, url)
+                if not needs_browser(html, page["text"]):
+                    browser_domains.discard(domain)
+                    if self.page_cache is not None:
+                        await self._cache_call(
+                            self.page_cache.put, url, page, **validators
+                        )
+                    return page
+
+                # Only pages that came back but need JavaScript count against their
+                # domain, so a transient failure doesn't send later fetches to the
+                # browser
+                dprint(f"{url} needs a browser, rendering it with Selenium...")
+                browser_domains.add(domain)
+            else:
+                dprint(f"HTTP fetch of {url} failed, rendering it with Selenium...")
+
+        return await self._fetch_content_rendered(url, cancelled)
+
+    async def _fetch_content_async(self, url, cancelled=None):
+        # Serve fresh pages straight from the cache, skipping the network and parsing
+        cached = None
+        if self.page_cache is not None:
+            cached = await self._cache_call(self.page_cache.get, url)
+        if cached is not None and cached.fresh:
+            dprint(f"Using cached content for {url}")
+            return cached.page
+
+        # Use futures to add a timeout for the content fetching, once the scheduler
+        # has a slot free for the URL's host
+        page = None
+        record_yield = True
+        cancelled = cancelled or threading.Event()
         try:
-            return await asyncio.wait_for(
-                loop.run_in_executor(self.executor, self._fetch_content, url),
-                timeout=self.timeout,
-            )
+            async with self.scheduler.slot(url):
+                # Run blocking content fetch in the custom thread pool executor
+                if self.fetch_mode == FetchMode.Tiered:
+                    fetch = self._fetch_content_tiered(url, cancelled, cached)
+                else:
+                    fetch = self._fetch_content_rendered(url, cancelled)
+                page = await asyncio.wait_for(fetch, timeout=self.timeout)
         except asyncio.TimeoutError:
             dprint(f"Timeout occurred while fetching content from {url}")
-            return None
+            record_yield = False
+        except PageRefused as e:
+            dprint(f"Not rendering {url}: {e}")
+            record_yield = False
         except Exception as e:
             dprint(f"An error occurred while fetching content from {url}: {e}")
-            return None
 
-    async def load_data(self, urls):
-        # Use asyncio.gather to fetch content from URLs concurrently
-        tasks = [self._fetch_content_async(url) for url in urls]
-        dprint("Done fetching content from URLs...")
-        webpages = await asyncio.gather(*tasks)
+        # Remember how much text the domain yielded, to rank future search results. A
+        # timeout, throttling or a missing page says nothing about the domain's content.
+        if record_yield:
+            get_domain_yields().record(url, page)
+        return page
+
+    async def iter_data(self, urls, timeout=None):
+        """
+        Yields pages as soon as each one finishes loading, instead of waiting for all of
+        them. Fetches that haven't finished when the caller stops iterating, or when the
+        timeout runs out, are cancelled.
+
+        Args:
+            urls (list): The URLs to fetch.
+            timeout (float): Optional number of seconds after which to stop waiting.
+        """
+        # Setting these stops the fetches' render threads, which cancelling the tasks
+        # alone doesn't
+        cancel_events = [threading.Event() for _ in urls]
+        tasks = [
+            asyncio.ensure_future(self._fetch_content_async(url, cancelled))
+            for url, cancelled in zip(urls, cancel_events)
+        ]
+        try:
+            for next_page in asyncio.as_completed(tasks, timeout=timeout):
+                try:
+                    page = await next_page
+                except asyncio.TimeoutError:
+                    dprint("Stopped waiting for the remaining slow pages")
+                    break
 
-        # Filter out any None results from failed requests
-        webpages = [page for page in webpages if page is not None]
+                # Skip failed requests
+                if page is not None:
+                    yield page
+        finally:
+            for cancelled, task in zip(cancel_events, tasks):
+                cancelled.set()
+                task.cancel()
 
+    async def load_data(self, urls, quorum=None, timeout=None):
+        """
+        Fetches the URLs concurrently and returns the loaded pages in the order they
+        finished.
+
+        Args:
+            urls (list): The URLs to fetch.
+            quorum (int): Optional number of good pages after which to stop waiting.
+            timeout (float): Optional number of seconds after which to stop waiting.
+        """
+        webpages = []
+        good_pages = 0
+        async with aclosing(self.iter_data(urls, timeout=timeout)) as pages:
+            async for page in pages:
+                webpages.append(page)
+                if is_good_page(page):
+                    good_pages += 1
+                if quorum is not None and good_pages >= quorum:
+                    dprint(f"Got {good_pages} good pages, skipping the rest...")
+                    break
+
+        dprint("Done fetching content from URLs...")
         return webpages
 
     def close_executor(self):
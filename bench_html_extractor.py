@@ -0,0 +1,171 @@
+"""
+Benchmarks html_extractor.extract_page against the BeautifulSoup extraction it replaced,
+over a directory of saved HTML pages.
+
+Before timing, the built-in regression pages are checked to still keep their article
+text and drop their ads.
+
+Usage:
+    python bench_html_extractor.py PAGES_DIR [--iterations N]
+    python bench_html_extractor.py PAGES_DIR --save URL [URL ...]
+"""
+
+import argparse
+import os
+import re
+import time
+import tracemalloc
+
+import requests
+
+from bs4 import BeautifulSoup
+
+from html_extractor import extract_page
+
+ARTICLE_TEXT = (
+    "The Bosch 800 Series is the quietest dishwasher we tested at 42 dB. " * 12
+)
+AD_TEXT = "Buy one get one free on mattresses this weekend only."
+
+# Layout wrappers that look like boilerplate, each around a page's article
+REGRESSION_WRAPPERS = [
+    '<div class="content-area has-sidebar">{}</div>',
+    '<div class="layout--with-sidebar">{}</div>',
+    '<div class="post-content share-enabled">{}</div>',
+    '<div class="entry ad-free">{}</div>',
+    '<div class="sidebar">{}</div>',
+    '<div id="related-wrapper"><article>{}</article></div>',
+    '<form id="aspnetForm"><div>{}</div></form>',
+]
+
+REGRESSION_PAGES = [
+    (
+        f"wrapper-{number}",
+        "<html><body><nav>Home Reviews Deals</nav>"
+        + wrapper.format(f"<p>{ARTICLE_TEXT}</p>")
+        + f'<div class="ad-slot">{AD_TEXT}</div></body></html>',
+    )
+    for number, wrapper in enumerate(REGRESSION_WRAPPERS, 1)
+]
+
+
+def check_regressions():
+    """
+    Prints which regression pages lost their article text or kept their ads.
+    """
+    failures = 0
+    for name, html in REGRESSION_PAGES:
+        text = extract_page(html, name)["text"]
+        problems = []
+        if ARTICLE_TEXT.strip() not in text:
+            problems.append(f"article dropped ({len(text)} chars kept)")
+        if AD_TEXT in text:
+            problems.append("ad kept")
+        if problems:
+            failures += 1
+            print(f"  {name}: {', '.join(problems)}")
+    print(
+        f"{len(REGRESSION_PAGES) - failures}/{len(REGRESSION_PAGES)} regression pages OK\n"
+    )
+
+
+def legacy_extract_page(html, url):
+    """
+    The BeautifulSoup html.parser + prettify extraction AsyncWebReader used to run.
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    for element in soup(["script", "style", "header", "footer", "nav", "aside"]):
+        element.decompose()
+    return {
+        "text": soup.get_text(separator="\n", strip=True),
+        "html": soup.prettify(),
+        "url": url,
+    }
+
+
+def save_pages(pages_dir, urls):
+    os.makedirs(pages_dir, exist_ok=True)
+    headers = {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+    }
+    for url in urls:
+        response = requests.get(url, headers=headers, timeout=15)
+        name = re.sub(r"[^A-Za-z0-9]+", "_", url.split("://", 1)[-1]).strip("_")
+        path = os.path.join(pages_dir, f"{name[:100]}.html")
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(response.text)
+        print(f"Saved {url} ({len(response.text)} chars) to {path}")
+
+
+def load_pages(pages_dir):
+    pages = []
+    for name in sorted(os.listdir(pages_dir)):
+        if name.endswith((".html", ".htm")):
+            with open(os.path.join(pages_dir, name), encoding="utf-8") as file:
+                pages.append((name, file.read()))
+    return pages
+
+
+def measure(extract_fn, pages, iterations):
+    # CPU time over all iterations, and the peak memory of a single pass. tracemalloc
+    # only sees Python allocations, so libxml2's own parse tree isn't counted; the
+    # kept content is the part that stays alive after parsing either way.
+    start = time.process_time()
+    for _ in range(iterations):
+        for name, html in pages:
+            extract_fn(html, name)
+    cpu_time = (time.process_time() - start) / iterations
+
+    tracemalloc.start()
+    results = [extract_fn(html, name) for name, html in pages]
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    output_chars = sum(
+        len(result["text"]) + len(result.get("html", "")) for result in results
+    )
+    return cpu_time, peak_memory, output_chars
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("pages_dir", help="Directory of saved .html pages")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--save", nargs="+", metavar="URL", help="Save pages first")
+    args = parser.parse_args()
+
+    if args.save:
+        save_pages(args.pages_dir, args.save)
+
+    check_regressions()
+
+    pages = load_pages(args.pages_dir)
+    if not pages:
+        print(f"No .html pages found in {args.pages_dir}")
+        return
+    input_chars = sum(len(html) for _, html in pages)
+    print(f"{len(pages)} pages, {input_chars / 1024:.0f} KiB of HTML\n")
+
+    results = {}
+    for label, extract_fn in [
+        ("BeautifulSoup + prettify", legacy_extract_page),
+        ("html_extractor", extract_page),
+    ]:
+        results[label] = measure(extract_fn, pages, args.iterations)
+        cpu_time, peak_memory, output_chars = results[label]
+        print(
+            f"{label:<26} CPU {cpu_time * 1000:8.1f} ms/pass   "
+            f"peak memory {peak_memory / 1024 / 1024:7.1f} MiB   "
+            f"kept {output_chars / 1024:7.0f} KiB"
+        )
+
+    legacy, current = results.values()
+    print(
+        f"\nCPU {legacy[0] / current[0]:.1f}x faster, "
+        f"peak memory {legacy[1] / current[1]:.1f}x lower, "
+        f"{legacy[2] / max(current[2], 1):.1f}x less content kept per page"
+    )
+
+
+if __name__ == "__main__":
+    main()
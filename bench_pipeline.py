@@ -0,0 +1,90 @@
+"""
+Times search_and_process end to end and per stage, recording the run into a cassette or
+replaying one, so the pipeline can be benchmarked offline with realistic latencies.
+
+Usage:
+    python bench_pipeline.py --record "SEARCH QUERY" "LLM PROMPT" [--cassette PATH]
+    python bench_pipeline.py --replay "SEARCH QUERY" "LLM PROMPT" [--latency-scale S]
+        [--sessions N]
+
+With --sessions, N searches run at once on one event loop, and the event loop lag they
+cause for each other is reported.
+"""
+
+import argparse
+import asyncio
+import os
+import time
+
+
+class StatusMessage:
+    """
+    Stands in for the Chainlit status message, timing each status update.
+    """
+
+    def __init__(self):
+        self.content = ""
+        self.started_at = time.monotonic()
+        self.updates = []
+
+    async def update(self):
+        self.updates.append((time.monotonic() - self.started_at, self.content))
+
+    async def stream_token(self, token):
+        # Only the first token is timed, since it's what the user waits for
+        if not self.content:
+            self.updates.append(
+                (time.monotonic() - self.started_at, f"First token: {token}")
+            )
+        self.content += token
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("search_query")
+    parser.add_argument("llm_prompt")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--record", action="store_true")
+    mode.add_argument("--replay", action="store_true")
+    parser.add_argument("--cassette", default="cassette.db")
+    parser.add_argument("--latency-scale", default="1.0")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument(
+        "--sessions", type=int, default=1, help="Concurrent sessions per run"
+    )
+    args = parser.parse_args()
+
+    # The cassette is configured from the environment when app is imported
+    os.environ["CASSETTE_MODE"] = "record" if args.record else "replay"
+    os.environ["CASSETTE_PATH"] = args.cassette
+    os.environ["CASSETTE_LATENCY_SCALE"] = args.latency_scale
+    from app import search_and_process
+    from loop_monitor import loop_lag_monitor
+
+    async def run_session(run, session):
+        status_message = StatusMessage()
+        await search_and_process(args.search_query, args.llm_prompt, status_message)
+        print(f"Run {run}, session {session}:")
+        previous = 0.0
+        for elapsed, content in status_message.updates:
+            stage = content.splitlines()[0][:70] if content else ""
+            print(f"  {elapsed:6.2f}s (+{elapsed - previous:5.2f}s)  {stage}")
+            previous = elapsed
+        print(f"  Total {previous:.2f}s\n")
+
+    async def run_all():
+        # One event loop for every run, so the shared HTTP session stays usable. The
+        # sessions of each run share the loop like concurrent chat sessions do.
+        loop_lag_monitor.start()
+        for run in range(1, args.repeat + 1):
+            await asyncio.gather(
+                *(run_session(run, session) for session in range(1, args.sessions + 1))
+            )
+        loop_lag_monitor.stop()
+        print(f"Event loop lag over all runs: {loop_lag_monitor.report()}")
+
+    asyncio.run(run_all())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Measures page load time and bytes transferred when rendering pages with the full and the
+lean Chrome profile.
+
+Usage:
+    python bench_render_profile.py URL [URL ...] [--repeat N]
+"""
+
+import argparse
+import json
+import time
+
+from browser_pool import BrowserPool, build_chrome_options
+from page_readiness import wait_for_page_ready
+
+
+def transferred_bytes(driver):
+    # Sum the encoded size of every response Chrome finished loading, from the
+    # performance log, which covers cross-origin requests the Resource Timing API hides
+    total = 0
+    for entry in driver.get_log("performance"):
+        message = json.loads(entry["message"])["message"]
+        if message["method"] == "Network.loadingFinished":
+            total += message["params"].get("encodedDataLength", 0)
+    return total
+
+
+def measure(url, pool):
+    pooled = pool.acquire()
+    try:
+        # Drain log entries left over from the previous page
+        pooled.driver.get_log("performance")
+        start = time.monotonic()
+        pooled.driver.get(url)
+        wait_for_page_ready(pooled.driver, url)
+        load_time = time.monotonic() - start
+        return load_time, transferred_bytes(pooled.driver)
+    finally:
+        pool.release(pooled)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("urls", nargs="+")
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    totals = {}
+    for lean in (False, True):
+        label = "lean" if lean else "full"
+        options = build_chrome_options(lean)
+        options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+        pool = BrowserPool(size=1, options=options, lean=lean)
+        load_time_total, bytes_total = 0.0, 0
+        try:
+            for url in args.urls:
+                for _ in range(args.repeat):
+                    load_time, transferred = measure(url, pool)
+                    load_time_total += load_time
+                    bytes_total += transferred
+                    print(
+                        f"[{label}] {url}: {load_time:.2f}s, {transferred / 1024:.0f} KiB"
+                    )
+        finally:
+            pool.close()
+        totals[label] = (load_time_total, bytes_total)
+
+    runs = len(args.urls) * args.repeat
+    print()
+    for label, (load_time_total, bytes_total) in totals.items():
+        print(
+            f"{label}: avg {load_time_total / runs:.2f}s, "
+            f"avg {bytes_total / runs / 1024:.0f} KiB per page"
+        )
+    (full_time, full_bytes), (lean_time, lean_bytes) = totals.values()
+    print(
+        f"\nLean profile: {full_time / max(lean_time, 1e-9):.1f}x faster, "
+        f"{full_bytes / max(lean_bytes, 1):.1f}x fewer bytes"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Benchmarks the hybrid BM25 + vector retriever against the vector-only retriever on
+retrieval latency and hit rate.
+
+Each case in CASES_FILE is a JSON object with the user's "query", the "expected" strings
+(e.g. product names or model numbers) a good chunk should contain, and either the
+"pages" to search as {"url", "text"} objects or the "urls" of pages already in the page
+cache. A case is a hit when any of the top-k chunks contains any expected string.
+
+Usage:
+    python bench_retriever.py CASES_FILE [--top-k K] [--repeat N]
+"""
+
+import argparse
+import json
+import time
+
+from dotenv import load_dotenv
+from llama_index.core import Settings, VectorStoreIndex
+from llama_index.core.schema import MetadataMode, QueryBundle
+
+from embedding_cache import install_embedding_cache
+from hybrid_retriever import HybridRetriever
+from page_cache import get_page_cache
+from vector_store import VectorStore
+
+
+def load_pages(case):
+    if "pages" in case:
+        return case["pages"]
+    page_cache = get_page_cache()
+    pages = []
+    for url in case["urls"]:
+        cached = page_cache.get(url)
+        if cached is None:
+            print(f"  {url} isn't in the page cache, skipping it")
+        else:
+            pages.append(cached.page)
+    return pages
+
+
+def is_hit(results, expected):
+    texts = [
+        result.node.get_content(metadata_mode=MetadataMode.NONE).lower()
+        for result in results
+    ]
+    return any(value.lower() in text for value in expected for text in texts)
+
+
+def measure(retriever, query_bundle, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        results = retriever.retrieve(query_bundle)
+    return (time.perf_counter() - start) / repeat, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("cases_file")
+    parser.add_argument("--top-k", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    load_dotenv()
+    install_embedding_cache()
+    with open(args.cases_file) as file:
+        cases = json.load(file)
+
+    # A throwaway store, so the benchmark doesn't touch the app's vector store
+    vector_store = VectorStore(path=":memory:")
+    totals = {"vector": [0.0, 0.0, 0], "hybrid": [0.0, 0.0, 0]}
+    for case in cases:
+        print(f"{case['query']}")
+        pages = load_pages(case)
+        for page in pages:
+            vector_store.upsert(page["url"], page["text"])
+        nodes = vector_store.get_nodes([page["url"] for page in pages])
+
+        # Embed the query once, so only retrieval itself is timed
+        embedding = Settings.embed_model.get_query_embedding(case["query"])
+        query_bundle = QueryBundle(case["query"], embedding=embedding)
+
+        for label in totals:
+            start = time.perf_counter()
+            if label == "vector":
+                retriever = VectorStoreIndex(nodes).as_retriever(
+                    similarity_top_k=args.top_k
+                )
+            else:
+                retriever = HybridRetriever(nodes, similarity_top_k=args.top_k)
+            build_time = time.perf_counter() - start
+            retrieve_time, results = measure(retriever, query_bundle, args.repeat)
+            hit = is_hit(results, case["expected"])
+            totals[label][0] += build_time
+            totals[label][1] += retrieve_time
+            totals[label][2] += hit
+            print(
+                f"  {label:<7} build {build_time * 1000:7.1f} ms   "
+                f"retrieve {retrieve_time * 1000:6.2f} ms   "
+                f"{'hit' if hit else 'miss'} ({len(nodes)} chunks)"
+            )
+
+    print()
+    for label, (build_time, retrieve_time, hits) in totals.items():
+        print(
+            f"{label:<7} avg build {build_time / len(cases) * 1000:7.1f} ms   "
+            f"avg retrieve {retrieve_time / len(cases) * 1000:6.2f} ms   "
+            f"hit rate {hits / len(cases):.0%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
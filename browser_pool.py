@@ -0,0 +1,367 @@
+import atexit
+import os
+import threading
+import time
+
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.chrome.options import Options
+
+from helpers import dprint
+
+# Number of Chrome instances kept alive for the whole process
+BROWSER_POOL_SIZE = int(os.getenv("BROWSER_POOL_SIZE", "4"))
+
+# Recycle a driver after it has rendered this many pages to cap memory growth
+BROWSER_MAX_PAGES = int(os.getenv("BROWSER_MAX_PAGES", "50"))
+
+# Seconds to wait for a free driver before giving up
+BROWSER_ACQUIRE_TIMEOUT = 30
+
+# Seconds between checks of whether a render waiting for a free driver was cancelled
+CANCEL_POLL_INTERVAL = 0.25
+
+# Seconds Chrome is allowed to spend loading a single page
+BROWSER_PAGE_LOAD_TIMEOUT = 20
+
+# Skip images, media, fonts and trackers when rendering, since only the text and links
+# are kept. Set LEAN_RENDER=false to render pages in full when debugging.
+LEAN_RENDER = os.getenv("LEAN_RENDER", "true").lower() != "false"
+
+# Ad and tracker domains that are never loaded in lean mode, plus any listed in the
+# comma-separated BLOCKED_DOMAINS
+TRACKER_DOMAINS = [
+    "doubleclick.net",
+    "googlesyndication.com",
+    "googletagmanager.com",
+    "googletagservices.com",
+    "google-analytics.com",
+    "amazon-adsystem.com",
+    "adnxs.com",
+    "criteo.com",
+    "taboola.com",
+    "outbrain.com",
+    "scorecardresearch.com",
+    "quantserve.com",
+    "moatads.com",
+    "chartbeat.com",
+    "hotjar.com",
+    "facebook.net",
+    "pubmatic.com",
+    "rubiconproject.com",
+    "openx.net",
+] + [
+    domain.strip()
+    for domain in os.getenv("BLOCKED_DOMAINS", "").split(",")
+    if domain.strip()
+]
+
+# Images, media and web fonts, which lean mode never downloads
+BLOCKED_RESOURCE_PATTERNS = [
+    pattern
+    for extension in [
+        "png",
+        "jpg",
+        "jpeg",
+        "gif",
+        "webp",
+        "avif",
+        "mp4",
+        "webm",
+        "mp3",
+        "m3u8",
+        "woff",
+        "woff2",
+        "ttf",
+        "otf",
+    ]
+    for pattern in (f"*.{extension}", f"*.{extension}?*")
+]
+
+
+def build_chrome_options(lean=LEAN_RENDER):
+    """
+    Builds the headless Chrome options shared by every pooled driver.
+
+    Args:
+        lean (bool): Whether to turn off images, extensions and prefetching.
+    """
+    # Setup Selenium options
+    chrome_options = Options()
+    chrome_options.add_argument("--headless")  # Run in headless mode
+    chrome_options.add_argument("--disable-gpu")  # Disable GPU
+    chrome_options.add_argument("--no-sandbox")  # Bypass OS security model
+    chrome_options.add_argument(
+        "--disable-dev-shm-usage"
+    )  # Overcome limited resource problems
+
+    # Return from driver.get() once the DOM is ready; wait_for_page_ready() decides
+    # when the rendered content has settled
+    chrome_options.page_load_strategy = "eager"
+
+    # Customize headers to avoid bot detection
+    chrome_options.add_argument(
+        "user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+    )
+
+    if lean:
+        chrome_options.add_argument("--blink-settings=imagesEnabled=false")
+        chrome_options.add_argument("--disable-extensions")
+        chrome_options.add_argument("--disable-background-networking")
+        chrome_options.add_argument("--dns-prefetch-disable")
+        chrome_options.add_argument("--mute-audio")
+        chrome_options.add_argument("--autoplay-policy=user-gesture-required")
+        chrome_options.add_experimental_option(
+            "prefs",
+            {
+                "profile.managed_default_content_settings.images": 2,
+                "profile.default_content_setting_values.notifications": 2,
+                "net.network_prediction_options": 2,
+            },
+        )
+
+    return chrome_options
+
+
+def block_resources(driver):
+    """
+    Stops the driver from downloading media, fonts and anything from tracker domains.
+    """
+    blocked_urls = BLOCKED_RESOURCE_PATTERNS + [
+        f"*{domain}*" for domain in TRACKER_DOMAINS
+    ]
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": blocked_urls})
+
+
+class PooledDriver:
+    """
+    A Chrome WebDriver owned by the pool, along with how many pages it has rendered.
+    """
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.pages = 0
+
+
+class RenderCancelled(Exception):
+    """
+    Raised when a render is cancelled because its page is no longer wanted.
+    """
+
+
+class BrowserPool:
+    """
+    A thread-safe pool of long-lived headless Chrome drivers.
+
+    Drivers are launched lazily up to `size`, handed out one at a time, and returned
+    to the pool after each page. A driver is recycled after `max_pages` pages, or as
+    soon as it crashes or fails a health check. Callers block until a driver is free.
+    """
+
+    def __init__(
+        self,
+        size=BROWSER_POOL_SIZE,
+        max_pages=BROWSER_MAX_PAGES,
+        options=None,
+        acquire_timeout=BROWSER_ACQUIRE_TIMEOUT,
+        lean=LEAN_RENDER,
+    ):
+        self.size = size
+        self.max_pages = max_pages
+        self.lean = lean
+        self.options = options or build_chrome_options(lean)
+        self.acquire_timeout = acquire_timeout
+        self._idle = []
+        self._total = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def _launch(self):
+        dprint("Launching a new headless Chrome for the browser pool...")
+        driver = webdriver.Chrome(options=self.options)
+        driver.set_page_load_timeout(BROWSER_PAGE_LOAD_TIMEOUT)
+        if self.lean:
+            block_resources(driver)
+        return PooledDriver(driver)
+
+    def _quit(self, pooled):
+        try:
+            pooled.driver.quit()
+        except Exception as e:
+            dprint(f"Error shutting down pooled Chrome: {e}")
+
+    def _is_healthy(self, pooled):
+        try:
+            pooled.driver.execute_script("return 1")
+            return True
+        except Exception:
+            return False
+
+    def _reset(self, pooled):
+        """
+        Returns the driver to a single blank tab so the next page starts clean.
+        """
+        driver = pooled.driver
+        handles = driver.window_handles
+        for handle in handles[1:]:
+            driver.switch_to.window(handle)
+            driver.close()
+        driver.switch_to.window(handles[0])
+        driver.get("about:blank")
+
+    def _discard(self, pooled):
+        self._quit(pooled)
+        with self._cond:
+            self._total -= 1
+            self._cond.notify()
+
+    def acquire(self, timeout=None, cancelled=None):
+        """
+        Takes a driver out of the pool, launching one if the pool isn't full yet.
+
+        Args:
+            timeout (float): Seconds to wait for a free driver.
+            cancelled (threading.Event): Stops the wait once set.
+
+        Raises:
+            TimeoutError: If no driver becomes free within the timeout.
+            RenderCancelled: If the wait was cancelled.
+        """
+        timeout = self.acquire_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        pooled = None
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Browser pool has been closed")
+                if cancelled is not None and cancelled.is_set():
+                    raise RenderCancelled("Cancelled while waiting for a browser")
+                if self._idle:
+                    pooled = self._idle.pop()
+                    break
+                if self._total < self.size:
+                    self._total += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(
+                        f"No browser became free within {timeout} seconds"
+                    )
+                # Wake up now and then to notice cancellation
+                if cancelled is not None:
+                    remaining = min(remaining, CANCEL_POLL_INTERVAL)
+                self._cond.wait(remaining)
+
+        if pooled is not None and self._is_healthy(pooled):
+            return pooled
+        if pooled is not None:
+            dprint("Pooled Chrome failed its health check, replacing it...")
+            self._quit(pooled)
+
+        try:
+            return self._launch()
+        except Exception:
+            with self._cond:
+                self._total -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, pooled, crashed=False):
+        """
+        Gives a driver back to the pool, recycling it if it crashed or is worn out.
+        """
+        if crashed or self._closed or pooled.pages >= self.max_pages:
+            self._discard(pooled)
+            return
+
+        try:
+            self._reset(pooled)
+        except Exception as e:
+            dprint(f"Error resetting pooled Chrome, recycling it: {e}")
+            self._discard(pooled)
+            return
+
+        with self._cond:
+            self._idle.append(pooled)
+            self._cond.notify()
+
+    def warm(self, count=None):
+        """
+        Launches idle drivers ahead of time so the first searches skip Chrome startup.
+        """
+        count = self.size if count is None else min(count, self.size)
+        launched = []
+        try:
+            for _ in range(count):
+                launched.append(self.acquire(timeout=0))
+        except TimeoutError:
+            pass
+        finally:
+            for pooled in launched:
+                self.release(pooled)
+
+    def render(self, url, wait_fn=None, cancelled=None):
+        """
+        Loads the URL on a pooled driver and returns its page source.
+
+        Args:
+            url (str): The page to load.
+            wait_fn (callable): Optional function called with the driver after the
+                page has loaded, used to wait for the content to render.
+            cancelled (threading.Event): Set once the page is no longer wanted, so the
+                render gives its driver back instead of finishing.
+
+        Returns:
+            str: The rendered HTML of the page.
+
+        Raises:
+            RenderCancelled: If the render was cancelled before it finished.
+        """
+        pooled = self.acquire(cancelled=cancelled)
+        crashed = False
+        try:
+            if cancelled is not None and cancelled.is_set():
+                raise RenderCancelled(f"Cancelled rendering {url}")
+            pooled.pages += 1
+            pooled.driver.get(url)
+            if cancelled is not None and cancelled.is_set():
+                raise RenderCancelled(f"Cancelled rendering {url}")
+            if wait_fn is not None:
+                wait_fn(pooled.driver)
+            return pooled.driver.page_source
+        except TimeoutException:
+            raise
+        except WebDriverException:
+            crashed = True
+            raise
+        finally:
+            self.release(pooled, crashed=crashed)
+
+    def close(self):
+        """
+        Shuts down every idle driver; busy drivers are shut down when released.
+        """
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._total -= len(idle)
+            self._cond.notify_all()
+        for pooled in idle:
+            self._quit(pooled)
+
+
+_browser_pool = None
+_browser_pool_lock = threading.Lock()
+
+
+def get_browser_pool():
+    """
+    Returns the process-wide browser pool, creating it on first use.
+    """
+    global _browser_pool
+    with _browser_pool_lock:
+        if _browser_pool is None:
+            _browser_pool = BrowserPool()
+            atexit.register(_browser_pool.close)
+        return _browser_pool
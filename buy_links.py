@@ -0,0 +1,301 @@
+import difflib
+import json
+import re
+
+from helpers import get_domain
+
+# Stores whose product pages are worth linking to as a place to buy
+RETAILER_DOMAINS = {
+    "amazon.com",
+    "amzn.to",
+    "bestbuy.com",
+    "walmart.com",
+    "target.com",
+    "costco.com",
+    "homedepot.com",
+    "lowes.com",
+    "newegg.com",
+    "bhphotovideo.com",
+    "adorama.com",
+    "crutchfield.com",
+    "sweetwater.com",
+    "rei.com",
+    "wayfair.com",
+    "ebay.com",
+    "apple.com",
+    "dell.com",
+    "lenovo.com",
+    "samsung.com",
+    "kohls.com",
+    "macys.com",
+    "nordstrom.com",
+    "sephora.com",
+    "ulta.com",
+    "chewy.com",
+    "dickssportinggoods.com",
+    "zappos.com",
+}
+
+# Redirects and URL parameters used by affiliate networks to link to stores
+AFFILIATE_PATTERN = re.compile(
+    r"go\.redirectingat\.com|go\.skimresources\.com|click\.linksynergy\.com|"
+    r"anrdoezrs\.net|jdoqocy\.com|tkqlhce\.com|dpbolvw\.net|kqzyfj\.com|"
+    r"shareasale\.com|avantlink\.com|pjtra\.com|pntra\.com|howl\.me|sovrn\.co|"
+    r"bestbuy\.7tiv\.net|goto\.walmart\.com|goto\.target\.com|"
+    r"[?&](?:tag|affid|aff_id|affiliate_id|irgwc)=",
+    re.IGNORECASE,
+)
+
+# Anchor text words that say where or how to buy rather than what is being bought
+GENERIC_ANCHOR_WORDS = {
+    "buy",
+    "shop",
+    "now",
+    "check",
+    "see",
+    "view",
+    "price",
+    "prices",
+    "pricing",
+    "deal",
+    "deals",
+    "at",
+    "on",
+    "from",
+    "here",
+    "available",
+    "get",
+    "it",
+    "the",
+    "latest",
+    "current",
+    "lowest",
+    "for",
+    "more",
+    "read",
+    "opens",
+    "in",
+    "a",
+    "new",
+    "tab",
+    "window",
+    "store",
+    "retailer",
+    "retailers",
+    "amazon",
+    "best",
+    "walmart",
+    "target",
+    "costco",
+    "newegg",
+    "ebay",
+    "apple",
+    "rei",
+    "wayfair",
+    "b&h",
+    "bh",
+    "photo",
+    "adorama",
+    "home",
+    "depot",
+    "lowe's",
+    "lowes",
+    "was",
+    "sale",
+    "off",
+    "save",
+}
+
+# Words that don't tell products apart when matching names
+NAME_STOPWORDS = {"the", "a", "an", "and", "with", "for", "by", "of", "in", "new"}
+
+PRICE_WORD_PATTERN = re.compile(r"^\$?[\d,.]+%?$")
+
+# Leading list numbering, and "Best overall:"-style labels in front of product names
+NUMBERING_PATTERN = re.compile(r"^\s*(?:#?\d+[.):]?|[-*•])\s+")
+LABEL_PATTERN = re.compile(
+    r"^(?:the\s+)?(?:best|top|runner[- ]up|budget|upgrade|our|also great|editor'?s)"
+    r"[^:]{0,40}:\s+(?=\S)",
+    re.IGNORECASE,
+)
+
+# Product names in a blurb, as bold spans or the lead of a list item
+BOLD_PATTERN = re.compile(r"\*\*(.+?)\*\*|__(.+?)__")
+LIST_ITEM_PATTERN = re.compile(
+    r"^\s*(?:\d+[.)]|[-*•])\s+(.+?)(?:\s+[-–—]\s|:\s|$)", re.MULTILINE
+)
+
+# Fraction of a product name's tokens a link's name must share to be its buy link
+MIN_MATCH_SCORE = 0.6
+
+# Fraction of a link's product name tokens a blurb must mention when the blurb doesn't
+# mark up its product names
+MIN_MENTION_SCORE = 0.8
+
+# Longest product name accepted from a heading or blurb
+MAX_NAME_LENGTH = 100
+
+
+def is_retailer_link(url):
+    domain = get_domain(url)
+    return any(
+        domain == retailer or domain.endswith("." + retailer)
+        for retailer in RETAILER_DOMAINS
+    )
+
+
+def is_buy_link(url):
+    """
+    Returns whether the URL points at a store, directly or through an affiliate link.
+    """
+    return is_retailer_link(url) or AFFILIATE_PATTERN.search(url) is not None
+
+
+def is_generic_anchor_text(text):
+    """
+    Returns whether anchor text like "$199 at Amazon" names no product.
+    """
+    words = [word.strip("()[],.!|") for word in text.lower().split()]
+    return all(
+        not word or word in GENERIC_ANCHOR_WORDS or PRICE_WORD_PATTERN.match(word)
+        for word in words
+    )
+
+
+def clean_product_name(text):
+    """
+    Strips list numbering and labels like "Best overall:" from a product name.
+    """
+    name = " ".join(text.split()).strip("*_ ")
+    name = NUMBERING_PATTERN.sub("", name)
+    name = LABEL_PATTERN.sub("", name)
+    return name.strip(" :-–—")[:MAX_NAME_LENGTH]
+
+
+def _tokens(text):
+    tokens = []
+    for word in text.lower().split():
+        token = re.sub(r"[^a-z0-9]", "", word)
+        if token and token not in NAME_STOPWORDS:
+            tokens.append(token)
+    return tokens
+
+
+def _weight(token):
+    # Model numbers tell products apart far better than words like "wireless"
+    return 2.0 if any(char.isdigit() for char in token) else 1.0
+
+
+def extract_blurb_product_names(blurb):
+    """
+    Returns the product names in a recommendation blurb, taken from bold spans or,
+    failing that, from the lead of each list item.
+    """
+    names = [bold or underlined for bold, underlined in BOLD_PATTERN.findall(blurb)]
+    if not names:
+        names = LIST_ITEM_PATTERN.findall(blurb)
+    names = [clean_product_name(name) for name in names]
+    return list(dict.fromkeys(name for name in names if _tokens(name)))
+
+
+class BuyLinkIndex:
+    """
+    An inverted index from product name tokens to the buy links found on pages, used
+    to fuzzy-match the products named in a blurb to their links.
+    """
+
+    def __init__(self, pages):
+        self.links = []
+        self.postings = {}
+        seen = set()
+        for page in pages:
+            for name, href in page.get("buy_links", []):
+                if href in seen:
+                    continue
+                seen.add(href)
+                tokens = set(_tokens(name))
+                if not tokens:
+                    continue
+                for token in tokens:
+                    self.postings.setdefault(token, set()).add(len(self.links))
+                self.links.append((name, href, tokens))
+
+    def _score(self, name_tokens, link_tokens):
+        total = sum(_weight(token) for token in name_tokens)
+        matched = 0.0
+        for token in name_tokens:
+            if token in link_tokens:
+                matched += _weight(token)
+            # Model numbers and generations must all match exactly, or an XM4 would
+            # pass for an XM5 and an "AirPods Pro" for an "AirPods Pro 2"
+            elif _weight(token) > 1.0:
+                return 0.0
+            elif difflib.get_close_matches(token, link_tokens, n=1, cutoff=0.85):
+                matched += _weight(token)
+        return matched / total
+
+    def best_link(self, product_name):
+        """
+        Returns the buy link whose product name best matches the given one, or None.
+        """
+        name_tokens = set(_tokens(product_name))
+        candidates = set()
+        for token in name_tokens:
+            candidates |= self.postings.get(token, set())
+
+        best, best_key = None, None
+        for candidate in candidates:
+            _, href, link_tokens = self.links[candidate]
+            score = self._score(name_tokens, link_tokens)
+            # Prefer direct store links over affiliate redirects on a tie
+            key = (score, is_retailer_link(href))
+            if score >= MIN_MATCH_SCORE and (best_key is None or key > best_key):
+                best, best_key = href, key
+        return best
+
+    def match(self, blurb):
+        """
+        Maps the products named in the blurb to their buy links.
+
+        Returns:
+            list: [product name, link] pairs, in the order the blurb names them.
+        """
+        names = extract_blurb_product_names(blurb)
+        if names:
+            matches = [[name, self.best_link(name)] for name in names]
+            return [[name, href] for name, href in matches if href]
+
+        # The blurb doesn't mark up its product names, so look for the links' own
+        # product names in it instead
+        blurb_tokens = set(_tokens(blurb))
+        matches = {}
+        for name, href, link_tokens in self.links:
+            if len(link_tokens) < 2 or name in matches:
+                continue
+            if self._score(link_tokens, blurb_tokens) >= MIN_MENTION_SCORE:
+                matches[name] = href
+        return [[name, href] for name, href in matches.items()]
+
+
+def parse_links_json(text):
+    """
+    Parses the LLM's list of [product name, link] pairs, tolerating code fences and
+    text around the JSON. Malformed items are dropped.
+    """
+    start, end = text.find("["), text.rfind("]")
+    if start == -1 or end <= start:
+        return []
+    try:
+        items = json.loads(text[start : end + 1])
+    except ValueError:
+        return []
+    if not isinstance(items, list):
+        return []
+    return [
+        [item[0], item[1]]
+        for item in items
+        if isinstance(item, list)
+        and len(item) == 2
+        and all(isinstance(value, str) for value in item)
+        and item[1].startswith(("http://", "https://"))
+    ]
@@ -0,0 +1,255 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+import httpx
+
+from helpers import dprint
+
+# "record" captures search results, page payloads and OpenAI responses into the
+# cassette; "replay" serves them back without touching the network
+CASSETTE_MODE = os.getenv("CASSETTE_MODE", "").lower()
+CASSETTE_PATH = os.getenv("CASSETTE_PATH", "cassette.db")
+
+# On replay, each call sleeps for its recorded latency times this scale, plus a fixed
+# number of extra seconds. Set the scale to 0 to replay as fast as possible.
+CASSETTE_LATENCY_SCALE = float(os.getenv("CASSETTE_LATENCY_SCALE", "1.0"))
+CASSETTE_EXTRA_LATENCY = float(os.getenv("CASSETTE_EXTRA_LATENCY", "0"))
+
+# Response headers worth keeping; the body is stored already decoded
+KEPT_RESPONSE_HEADERS = ("content-type", "x-request-id", "openai-model")
+
+
+class CassetteMiss(KeyError):
+    """
+    Raised on replay when a call was never recorded.
+    """
+
+
+class Cassette:
+    """
+    A compact store of recorded calls, keyed by the kind of call and its arguments.
+
+    Payloads are stored zlib-compressed as JSON in a single SQLite file, along with
+    how long the live call took so replays can reproduce the latency.
+    """
+
+    def __init__(
+        self,
+        path=CASSETTE_PATH,
+        mode=CASSETTE_MODE,
+        latency_scale=CASSETTE_LATENCY_SCALE,
+        extra_latency=CASSETTE_EXTRA_LATENCY,
+    ):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self.extra_latency = extra_latency
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS calls (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                payload BLOB NOT NULL,
+                latency REAL NOT NULL,
+                PRIMARY KEY (kind, key)
+            )
+            """)
+        self._conn.commit()
+
+    def _key(self, key_parts):
+        return hashlib.sha256(json.dumps(key_parts).encode("utf-8")).hexdigest()
+
+    def _load(self, kind, key_parts):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT payload, latency FROM calls WHERE kind = ? AND key = ?",
+                (kind, self._key(key_parts)),
+            ).fetchone()
+        if row is None:
+            raise CassetteMiss(f"No recorded {kind} call for {key_parts}")
+        payload, latency = row
+        delay = latency * self.latency_scale + self.extra_latency
+        return json.loads(zlib.decompress(payload)), delay
+
+    def _save(self, kind, key_parts, payload, latency):
+        data = zlib.compress(json.dumps(payload).encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO calls VALUES (?, ?, ?, ?)",
+                (kind, self._key(key_parts), data, latency),
+            )
+            self._conn.commit()
+
+    def call(self, kind, key_parts, live_fn):
+        """
+        Records or replays a blocking call whose result is JSON-serializable.
+
+        Args:
+            kind (str): The kind of call, e.g. "search" or "http_page".
+            key_parts (list): The arguments that identify the call.
+            live_fn (callable): Makes the live call when recording.
+        """
+        if self.mode == "replay":
+            payload, delay = self._load(kind, key_parts)
+            time.sleep(delay)
+            return payload
+
+        started_at = time.monotonic()
+        payload = live_fn()
+        self._save(kind, key_parts, payload, time.monotonic() - started_at)
+        return payload
+
+    async def acall(self, kind, key_parts, live_fn):
+        """
+        Records or replays a call like call(), where live_fn returns an awaitable.
+        """
+        if self.mode == "replay":
+            payload, delay = self._load(kind, key_parts)
+            await asyncio.sleep(delay)
+            return payload
+
+        started_at = time.monotonic()
+        payload = await live_fn()
+        self._save(kind, key_parts, payload, time.monotonic() - started_at)
+        return payload
+
+    def http_client(self):
+        """
+        Returns an httpx client whose requests go through the cassette.
+        """
+        return httpx.Client(transport=CassetteTransport(self))
+
+    def async_http_client(self):
+        """
+        Returns an async httpx client whose requests go through the cassette.
+        """
+        return httpx.AsyncClient(transport=AsyncCassetteTransport(self))
+
+
+def _request_key(request):
+    body = hashlib.sha256(request.content).hexdigest()
+    return [request.method, str(request.url), body]
+
+
+def _response_payload(response, content):
+    headers = {
+        name: value
+        for name, value in response.headers.items()
+        if name.lower() in KEPT_RESPONSE_HEADERS
+    }
+    return {
+        "status": response.status_code,
+        "headers": headers,
+        "content": content.decode("utf-8", errors="replace"),
+    }
+
+
+def _payload_response(payload, request):
+    return httpx.Response(
+        payload["status"],
+        headers=payload["headers"],
+        content=payload["content"].encode("utf-8"),
+        request=request,
+    )
+
+
+class CassetteTransport(httpx.BaseTransport):
+    """
+    An httpx transport that records or replays every request, e.g. OpenAI API calls.
+    Streamed responses are recorded whole and replayed as a single chunk.
+    """
+
+    def __init__(self, cassette, transport=None):
+        self.cassette = cassette
+        self.transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request):
+        def live():
+            response = self.transport.handle_request(request)
+            try:
+                return _response_payload(response, response.read())
+            finally:
+                response.close()
+
+        request.read()
+        payload = self.cassette.call("http", _request_key(request), live)
+        return _payload_response(payload, request)
+
+
+class AsyncCassetteTransport(httpx.AsyncBaseTransport):
+    """
+    The async counterpart of CassetteTransport.
+    """
+
+    def __init__(self, cassette, transport=None):
+        self.cassette = cassette
+        self.transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request):
+        async def live():
+            response = await self.transport.handle_async_request(request)
+            try:
+                return _response_payload(response, await response.aread())
+            finally:
+                await response.aclose()
+
+        await request.aread()
+        payload = await self.cassette.acall("http", _request_key(request), live)
+        return _payload_response(payload, request)
+
+
+_cassette = None
+_cassette_lock = threading.Lock()
+
+
+def get_cassette():
+    """
+    Returns the process-wide cassette, or None unless CASSETTE_MODE is set.
+    """
+    global _cassette
+    if not CASSETTE_MODE:
+        return None
+    with _cassette_lock:
+        if _cassette is None:
+            dprint(f"Using cassette {CASSETTE_PATH} in {CASSETTE_MODE} mode")
+            _cassette = Cassette()
+        return _cassette
+
+
+def cassette_async_http_client():
+    """
+    Returns an async httpx client for the OpenAI client, or None to use its default.
+    """
+    cassette = get_cassette()
+    return cassette.async_http_client() if cassette is not None else None
+
+
+def install_cassette():
+    """
+    Routes LlamaIndex's OpenAI LLM and embedding calls through the cassette, if one is
+    in use. The default models are kept.
+    """
+    cassette = get_cassette()
+    if cassette is None:
+        return
+
+    from llama_index.core import Settings
+    from llama_index.embeddings.openai import OpenAIEmbedding
+    from llama_index.llms.openai import OpenAI
+
+    Settings.llm = OpenAI(
+        http_client=cassette.http_client(),
+        async_http_client=cassette.async_http_client(),
+    )
+    Settings.embed_model = OpenAIEmbedding(
+        http_client=cassette.http_client(),
+        async_http_client=cassette.async_http_client(),
+    )
@@ -0,0 +1,122 @@
+import math
+import os
+import re
+
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import MetadataMode, NodeWithScore, TextNode
+from llama_index.core.utils import get_tokenizer
+
+from html_extractor import PRICE_PATTERN
+from hybrid_retriever import tokenize
+
+# Tokens of retrieved context sent with the recommendation prompt
+RAG_CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "1500"))
+
+# Model numbers and other names mixing letters and digits, like "WH-1000XM5" or "QC45"
+PRODUCT_PATTERN = re.compile(r"\b(?=[\w-]*\d)(?=[\w-]*[A-Za-z])[A-Za-z0-9][\w-]{2,}\b")
+
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+|\n+")
+
+# Sentences with this much of their own vocabulary already in a kept sentence are
+# dropped. A longer sentence that adds to a kept one, e.g. its price, is kept.
+REDUNDANT_SENTENCE_OVERLAP = 0.7
+
+# Extra relevance of a sentence that names a product or a price
+PRODUCT_SENTENCE_BONUS = 1.0
+
+
+def count_tokens(text):
+    return len(get_tokenizer()(text))
+
+
+def _covered(tokens, kept):
+    # The share of the sentence's vocabulary that a kept sentence already has
+    if not tokens:
+        return 1.0
+    return len(tokens & kept) / len(tokens)
+
+
+class ContextPacker(BaseNodePostprocessor):
+    """
+    Packs the retrieved chunks into a fixed token budget for the recommendation prompt.
+
+    Chunks are reranked by how much of the request their sentences mention. Sentences
+    that are irrelevant or repeat an already kept sentence are trimmed, except for the
+    ones naming products or prices. The budget is then filled greedily, best chunk
+    first, keeping each chunk's citation metadata.
+    """
+
+    token_budget: int = RAG_CONTEXT_TOKENS
+    packed_tokens: int = 0
+
+    @classmethod
+    def class_name(cls):
+        return "ContextPacker"
+
+    def _score_sentence(self, sentence, query_tokens):
+        tokens = set(tokenize(sentence))
+        relevance = len(tokens & query_tokens) / math.sqrt(len(tokens) + 1)
+        is_product = bool(
+            PRICE_PATTERN.search(sentence) or PRODUCT_PATTERN.search(sentence)
+        )
+        if is_product:
+            relevance += PRODUCT_SENTENCE_BONUS
+        return relevance, is_product, tokens
+
+    def _postprocess_nodes(self, nodes, query_bundle=None):
+        tokenizer = get_tokenizer()
+        query_text = " ".join(query_bundle.embedding_strs) if query_bundle else ""
+        query_tokens = set(tokenize(query_text))
+
+        # Trim each chunk to its relevant, non-redundant sentences, best chunks first
+        # so their copy of a repeated sentence is the one kept
+        candidates = []
+        for rank, node_with_score in enumerate(nodes):
+            sentences = []
+            for sentence in SENTENCE_PATTERN.split(node_with_score.node.get_content()):
+                sentence = sentence.strip()
+                if not sentence:
+                    continue
+                relevance, is_product, tokens = self._score_sentence(
+                    sentence, query_tokens
+                )
+                if relevance > 0 or is_product:
+                    sentences.append((sentence, relevance, tokens))
+            score = sum(relevance for _, relevance, _ in sentences)
+            candidates.append((score, -rank, node_with_score.node, sentences))
+        candidates.sort(key=lambda candidate: candidate[:2], reverse=True)
+
+        packed = []
+        kept_tokens = []
+        budget = self.token_budget
+        for score, _, node, sentences in candidates:
+            header_tokens = len(tokenizer(node.get_metadata_str(MetadataMode.LLM)))
+            if header_tokens >= budget:
+                continue
+            kept = []
+            used = header_tokens
+            for sentence, _, tokens in sentences:
+                if any(
+                    _covered(tokens, other) >= REDUNDANT_SENTENCE_OVERLAP
+                    for other in kept_tokens
+                ):
+                    continue
+                sentence_tokens = len(tokenizer(sentence))
+                if used + sentence_tokens > budget:
+                    continue
+                kept.append(sentence)
+                kept_tokens.append(tokens)
+                used += sentence_tokens
+            if not kept:
+                continue
+            budget -= used
+            packed_node = TextNode(
+                text=" ".join(kept),
+                metadata=dict(node.metadata),
+                excluded_llm_metadata_keys=node.excluded_llm_metadata_keys,
+                excluded_embed_metadata_keys=node.excluded_embed_metadata_keys,
+            )
+            packed.append(NodeWithScore(node=packed_node, score=score))
+
+        self.packed_tokens = self.token_budget - budget
+        return packed
@@ -0,0 +1,31 @@
+import time
+
+
+class Deadline:
+    """
+    A time budget shared by every stage of a request, so each stage can see how much time
+    is left and cut its work short instead of overrunning the whole request.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + budget
+
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    def remaining(self, reserve=0):
+        """
+        Returns the seconds left, minus any time reserved for later stages.
+        """
+        return max(0.0, self.expires_at - time.monotonic() - reserve)
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def cap(self, seconds, reserve=0):
+        """
+        Returns the given timeout, shortened if the deadline would pass first.
+        """
+        return min(seconds, self.remaining(reserve))
@@ -0,0 +1,307 @@
+import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from llama_index.core import Settings
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from pydantic import PrivateAttr
+
+from cassette import get_cassette
+from helpers import dprint
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no flock, so writers there are only serialized within the process
+    fcntl = None
+
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", "embedding_cache")
+
+# Number of texts sent to the embeddings endpoint per request
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "256"))
+
+# Maximum number of embedding requests in flight across every chat session
+EMBED_MAX_CONCURRENCY = int(os.getenv("EMBED_MAX_CONCURRENCY", "4"))
+
+# Attempts per embedding request, and the seconds waited before the first retry
+EMBED_RETRIES = 3
+EMBED_RETRY_DELAY = 1.0
+
+_embed_executor = ThreadPoolExecutor(max_workers=EMBED_MAX_CONCURRENCY)
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    A persistent store of embedding vectors keyed by model and text hash.
+
+    Each model's vectors are appended to a raw float32 file that is memory-mapped for
+    reads, so lookups don't load the whole store into memory. A SQLite index maps each
+    text hash to its row in the file. Appends hold an exclusive lock on the file, so
+    processes sharing the store don't index their vectors at each other's rows.
+    """
+
+    def __init__(self, directory=EMBEDDING_CACHE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._maps = {}
+        self._conn = sqlite3.connect(
+            os.path.join(directory, "index.db"), check_same_thread=False
+        )
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS models (
+                model TEXT PRIMARY KEY,
+                dim INTEGER NOT NULL
+            )
+            """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS vectors (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                row INTEGER NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            )
+            """)
+        self._conn.commit()
+
+    def _path(self, model):
+        return os.path.join(self.directory, re.sub(r"[^\w.-]+", "_", model) + ".f32")
+
+    def _vectors(self, model, dim, min_rows):
+        # Map the model's vector file, mapping it again if it has grown since
+        vectors = self._maps.get(model)
+        if vectors is None or len(vectors) < min_rows:
+            rows = os.path.getsize(self._path(model)) // (4 * dim)
+            vectors = np.memmap(
+                self._path(model), dtype=np.float32, mode="r", shape=(rows, dim)
+            )
+            self._maps[model] = vectors
+        return vectors
+
+    def get_many(self, model, hashes):
+        """
+        Returns the stored vectors for the given text hashes, by hash.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT dim FROM models WHERE model = ?", (model,)
+            ).fetchone()
+            if row is None:
+                return {}
+            (dim,) = row
+            found = {}
+            for start in range(0, len(hashes), 500):
+                batch = hashes[start : start + 500]
+                found.update(
+                    self._conn.execute(
+                        "SELECT text_hash, row FROM vectors WHERE model = ? "
+                        f"AND text_hash IN ({','.join('?' * len(batch))})",
+                        (model, *batch),
+                    ).fetchall()
+                )
+            if not found:
+                return {}
+            vectors = self._vectors(model, dim, max(found.values()) + 1)
+            return {key: vectors[row].tolist() for key, row in found.items()}
+
+    def put_many(self, model, hashes, embeddings):
+        """
+        Appends the vectors for the given text hashes to the model's vector file.
+        """
+        if not hashes:
+            return
+        data = np.asarray(embeddings, dtype=np.float32)
+        with self._lock:
+            dim = data.shape[1]
+            self._conn.execute(
+                "INSERT OR IGNORE INTO models VALUES (?, ?)", (model, dim)
+            )
+            with open(self._path(model), "ab") as file:
+                # The lock is held until the rows are indexed, so another process
+                # can't append between reading the file's size and writing the index
+                if fcntl is not None:
+                    fcntl.flock(file, fcntl.LOCK_EX)
+                first_row = os.fstat(file.fileno()).st_size // (4 * dim)
+                file.write(data.tobytes())
+                file.flush()
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO vectors VALUES (?, ?, ?)",
+                    [(model, key, first_row + i) for i, key in enumerate(hashes)],
+                )
+                self._conn.commit()
+
+
+class EmbeddingStats:
+    """
+    Counts embedding cache hits and misses and the time spent embedding the misses.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+        self.embed_time = 0.0
+
+    def record(self, hits, misses, requests, embed_time):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            self.requests += requests
+            self.embed_time += embed_time
+
+    def metrics(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "requests": self.requests,
+                "embed_time": self.embed_time,
+            }
+
+    def report(self):
+        metrics = self.metrics()
+        return (
+            f"{metrics['hits']} hit(s), {metrics['misses']} miss(es), "
+            f"{metrics['hit_rate']:.0%} hit rate, {metrics['requests']} request(s), "
+            f"{metrics['embed_time']:.2f}s embedding"
+        )
+
+
+embedding_stats = EmbeddingStats()
+
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    Wraps an embedding model, memoizing its vectors by model and text hash.
+
+    Texts that aren't cached yet are deduplicated and sent in batches of
+    EMBED_BATCH_SIZE, at most EMBED_MAX_CONCURRENCY requests at a time, each retried
+    with backoff if it fails.
+    """
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _store: EmbeddingStore = PrivateAttr()
+
+    def __init__(self, embed_model, store=None, **kwargs):
+        # LlamaIndex's own batching is skipped, so every miss can go out in one pass
+        super().__init__(
+            model_name=embed_model.model_name,
+            embed_batch_size=2048,
+            callback_manager=embed_model.callback_manager,
+            **kwargs,
+        )
+        self._embed_model = embed_model
+        self._store = store or get_embedding_store()
+
+    @classmethod
+    def class_name(cls):
+        return "CachedEmbedding"
+
+    def _embed_batch(self, texts, is_query):
+        delay = EMBED_RETRY_DELAY
+        for attempt in range(1, EMBED_RETRIES + 1):
+            try:
+                if is_query:
+                    return [self._embed_model._get_query_embedding(texts[0])]
+                return self._embed_model._get_text_embeddings(texts)
+            except Exception as e:
+                if attempt == EMBED_RETRIES:
+                    raise
+                dprint(f"Embedding request failed ({e}), retrying in {delay:.0f}s...")
+                time.sleep(delay)
+                delay *= 2
+
+    def _embed(self, texts, is_query=False):
+        # Queries get their own keys, since some models embed them differently
+        hashes = [text_hash(("query:" if is_query else "") + text) for text in texts]
+        cached = self._store.get_many(self.model_name, list(set(hashes)))
+
+        missing = {}
+        for key, text in zip(hashes, texts):
+            if key not in cached:
+                missing.setdefault(key, text)
+        missing_hashes = list(missing)
+        missing_texts = list(missing.values())
+
+        started_at = time.monotonic()
+        batches = [
+            missing_texts[start : start + EMBED_BATCH_SIZE]
+            for start in range(0, len(missing_texts), EMBED_BATCH_SIZE)
+        ]
+        embeddings = [
+            embedding
+            for batch_embeddings in _embed_executor.map(
+                lambda batch: self._embed_batch(batch, is_query), batches
+            )
+            for embedding in batch_embeddings
+        ]
+        embed_time = time.monotonic() - started_at
+
+        self._store.put_many(self.model_name, missing_hashes, embeddings)
+        cached.update(zip(missing_hashes, embeddings))
+        embedding_stats.record(
+            len(texts) - len(missing_texts),
+            len(missing_texts),
+            len(batches),
+            embed_time,
+        )
+        return [cached[key] for key in hashes]
+
+    def _get_query_embedding(self, query):
+        return self._embed([query], is_query=True)[0]
+
+    async def _aget_query_embedding(self, query):
+        return await asyncio.to_thread(self._get_query_embedding, query)
+
+    def _get_text_embedding(self, text):
+        return self._embed([text])[0]
+
+    def _get_text_embeddings(self, texts):
+        return self._embed(texts)
+
+    async def _aget_text_embeddings(self, texts):
+        return await asyncio.to_thread(self._get_text_embeddings, texts)
+
+
+_embedding_store = None
+_embedding_store_lock = threading.Lock()
+
+
+def get_embedding_store():
+    """
+    Returns the process-wide embedding store, opening it on first use.
+    """
+    global _embedding_store
+    with _embedding_store_lock:
+        if _embedding_store is None:
+            _embedding_store = EmbeddingStore()
+        return _embedding_store
+
+
+def install_embedding_cache():
+    """
+    Wraps LlamaIndex's current embedding model in the embedding cache.
+
+    With a cassette the cache is left out, so every embedding request goes through
+    the cassette whatever this machine has embedded before.
+    """
+    if get_cassette() is not None:
+        dprint("Not caching embeddings while a cassette is in use")
+        return
+    if not isinstance(Settings.embed_model, CachedEmbedding):
+        Settings.embed_model = CachedEmbedding(Settings.embed_model)
@@ -90,7 +90,9 @@ async def get_document(query):
         search_query=query, provider=Provider.DuckDuckGo, fetch_docs=True, max_results=10
     )
     if search_results:
-        return str(search_results)
+        return "\n\n".join(
+            f"URL: {page['url']}\n{page['text']}" for page in search_results
+        )
     return None
 
 
@@ -3,12 +3,15 @@ import time
 from langfuse import Langfuse
 import openai
 from dotenv import load_dotenv
-from llama_index.core import VectorStoreIndex, SimpleDirectoryReader
+from llama_index.core import SimpleDirectoryReader
 from async_web_reader import AsyncWebReader
 import asyncio
+from embedding_cache import install_embedding_cache
 from search_handler import Provider, search
+from vector_store import get_vector_store
 
 load_dotenv()
+install_embedding_cache()
 
 langfuse = Langfuse()
 
@@ -85,7 +88,11 @@ async def run_experiment(experiment_name):
                 documents = []
         # print(documents)
         if documents:
-            index = VectorStoreIndex.from_documents(documents)
+            # Pages seen in earlier runs are reused from the vector store, not re-embedded
+            vector_store = get_vector_store()
+            for page in documents:
+                vector_store.upsert(page["url"], page["text"])
+            index = vector_store.as_index([page["url"] for page in documents])
             query_engine = index.as_query_engine()
             completion, langfuse_generation = rag_query(query_engine, item.input)
             item.link(langfuse_generation, experiment_name)  # pass the observation/generation object or the id
@@ -98,4 +105,7 @@ async def run_experiment(experiment_name):
         time.sleep(15)
 
 
-asyncio.run(run_experiment("Experiment 2"))
\ No newline at end of file
+# Parse workers are spawned processes that import this script again, so the
+# experiment must only run in the main process
+if __name__ == "__main__":
+    asyncio.run(run_experiment("Experiment 2"))
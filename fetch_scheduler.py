@@ -0,0 +1,150 @@
+import asyncio
+import os
+import time
+
+from contextlib import asynccontextmanager
+
+from helpers import dprint, get_domain
+
+# Maximum number of page fetches running at once across every chat session
+FETCH_MAX_CONCURRENCY = int(os.getenv("FETCH_MAX_CONCURRENCY", "16"))
+
+# Maximum number of page fetches running at once against any single host
+FETCH_PER_HOST_CONCURRENCY = int(os.getenv("FETCH_PER_HOST_CONCURRENCY", "2"))
+
+# Seconds to back off from a host the first time it throttles us, doubling after that
+BACKOFF_INITIAL = 2
+BACKOFF_MAX = 60
+
+# Status codes that mean the host wants us to slow down
+THROTTLE_STATUSES = (429, 503)
+
+
+def parse_retry_after(value):
+    """
+    Returns the number of seconds in a Retry-After header, or None if it isn't a number.
+    """
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class HostStats:
+    """
+    Running totals of how long fetches to a host spent queued and running.
+    """
+
+    def __init__(self):
+        self.fetches = 0
+        self.queue_time = 0.0
+        self.run_time = 0.0
+        self.throttled = 0
+
+    def summary(self):
+        if not self.fetches:
+            return f"0 fetches, throttled {self.throttled}x"
+        return (
+            f"{self.fetches} fetches, "
+            f"avg queued {self.queue_time / self.fetches:.2f}s, "
+            f"avg running {self.run_time / self.fetches:.2f}s, "
+            f"throttled {self.throttled}x"
+        )
+
+
+class FetchScheduler:
+    """
+    Schedules page fetches politely: a global concurrency cap shared by every session,
+    a smaller cap per host, and exponential backoff from hosts that reply 429 or 503.
+    """
+
+    def __init__(
+        self,
+        max_concurrency=FETCH_MAX_CONCURRENCY,
+        per_host_concurrency=FETCH_PER_HOST_CONCURRENCY,
+    ):
+        self.per_host_concurrency = per_host_concurrency
+        self._global = asyncio.Semaphore(max_concurrency)
+        self._hosts = {}
+        self._backoff_until = {}
+        self._backoff_delay = {}
+        self.stats = {}
+
+    def _host_stats(self, host):
+        if host not in self.stats:
+            self.stats[host] = HostStats()
+        return self.stats[host]
+
+    @asynccontextmanager
+    async def slot(self, url):
+        """
+        Waits until the URL's host may be fetched, then holds a slot while the caller
+        fetches it.
+        """
+        host = get_domain(url)
+        if host not in self._hosts:
+            self._hosts[host] = asyncio.Semaphore(self.per_host_concurrency)
+
+        queued_at = time.monotonic()
+        # Take the host slot first, so requests stuck behind a busy host don't hold up
+        # the global slots other hosts could use
+        async with self._hosts[host]:
+            delay = self._backoff_until.get(host, 0) - time.monotonic()
+            if delay > 0:
+                dprint(f"Backing off from {host} for {delay:.1f}s...")
+                await asyncio.sleep(delay)
+
+            async with self._global:
+                started_at = time.monotonic()
+                try:
+                    yield
+                finally:
+                    queue_time = started_at - queued_at
+                    run_time = time.monotonic() - started_at
+                    stats = self._host_stats(host)
+                    stats.fetches += 1
+                    stats.queue_time += queue_time
+                    stats.run_time += run_time
+                    dprint(
+                        f"Fetched {url} after {queue_time:.2f}s queued and {run_time:.2f}s running"
+                    )
+
+    def record_status(self, url, status, retry_after=None):
+        """
+        Backs off from the URL's host if it throttled us, or clears its backoff otherwise.
+        """
+        host = get_domain(url)
+        if status not in THROTTLE_STATUSES:
+            self._backoff_delay.pop(host, None)
+            return
+
+        delay = parse_retry_after(retry_after)
+        if delay is None:
+            previous = self._backoff_delay.get(host)
+            delay = BACKOFF_INITIAL if previous is None else previous * 2
+        delay = min(delay, BACKOFF_MAX)
+        self._backoff_delay[host] = delay
+        self._backoff_until[host] = time.monotonic() + delay
+        self._host_stats(host).throttled += 1
+        dprint(f"{host} returned {status}, backing off for {delay}s")
+
+    def report(self):
+        """
+        Returns a per-host summary of queue time, run time and throttling.
+        """
+        return "\n".join(
+            f"{host}: {stats.summary()}" for host, stats in sorted(self.stats.items())
+        )
+
+
+_fetch_scheduler = None
+
+
+def get_fetch_scheduler():
+    """
+    Returns the process-wide fetch scheduler shared by every chat session.
+    """
+    global _fetch_scheduler
+    if _fetch_scheduler is None:
+        _fetch_scheduler = FetchScheduler()
+    return _fetch_scheduler
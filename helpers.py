@@ -1,5 +1,37 @@
 import os
 
+from urllib.parse import parse_qsl, urlencode, urlparse, urlsplit, urlunsplit
+
+# Query parameters that only track where a visitor came from, or ask for the AMP version
+TRACKING_PARAMS = {
+    "_ga",
+    "_gl",
+    "amp",
+    "dclid",
+    "fbclid",
+    "gclid",
+    "guccounter",
+    "guce_referrer",
+    "guce_referrer_sig",
+    "icid",
+    "igshid",
+    "mc_cid",
+    "mc_eid",
+    "mkt_tok",
+    "msclkid",
+    "ncid",
+    "outputtype",
+    "ref",
+    "ref_src",
+    "s_cid",
+    "sr_share",
+    "twclid",
+    "yclid",
+}
+
+# Subdomains that serve the main site, or AMP and mobile copies of its pages
+VARIANT_SUBDOMAINS = ("www.", "amp.", "m.", "mobile.")
+
 
 def dprint(message):
     """
@@ -8,3 +40,44 @@ def dprint(message):
     DEBUG = os.getenv("DEBUG_APP")
     if DEBUG:
         print(f"[DEBUG] {message}")
+
+
+def get_domain(url):
+    """
+    Returns the host name of the URL without any leading "www.".
+    """
+    domain = urlparse(url).netloc.lower()
+    return domain[4:] if domain.startswith("www.") else domain
+
+
+def canonicalize_url(url):
+    """
+    Normalizes a URL so that trivially different links to the same page compare equal,
+    dropping tracking parameters and collapsing AMP and mobile variants onto the page
+    they copy.
+    """
+    parts = urlsplit(url.strip())
+    scheme = "https" if parts.scheme.lower() in ("http", "https") else parts.scheme
+    host = (parts.hostname or "").lower()
+    for prefix in VARIANT_SUBDOMAINS:
+        if host.startswith(prefix) and host.count(".") >= 2:
+            host = host[len(prefix) :]
+            break
+    netloc = host
+    if parts.port and parts.port not in (80, 443):
+        netloc += f":{parts.port}"
+
+    segments = [
+        segment.replace(".amp.", ".")
+        for segment in parts.path.split("/")
+        if segment.lower() != "amp"
+    ]
+    path = "/".join(segments).rstrip("/") or "/"
+    query = urlencode(
+        sorted(
+            (key, value)
+            for key, value in parse_qsl(parts.query, keep_blank_values=True)
+            if not key.lower().startswith("utm_") and key.lower() not in TRACKING_PARAMS
+        )
+    )
+    return urlunsplit((scheme, netloc, path, query, ""))
@@ -0,0 +1,319 @@
+import asyncio
+import multiprocessing
+import os
+import re
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from lxml import etree
+from lxml import html as lxml_html
+from urllib.parse import urljoin
+
+from buy_links import clean_product_name, is_buy_link, is_generic_anchor_text
+from helpers import dprint
+
+# Number of worker processes parsing HTML, shared by every reader in the process
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", str(os.cpu_count() or 1)))
+
+# Elements that never hold the main content of a page
+REMOVED_TAGS = [
+    "script",
+    "style",
+    "noscript",
+    "template",
+    "header",
+    "footer",
+    "nav",
+    "aside",
+    "iframe",
+    "svg",
+]
+
+# Elements that are usually page chrome, like search boxes and sign-up forms, but are
+# kept when they hold the main content, e.g. the page-wide <form> of ASP.NET sites
+BOILERPLATE_TAGS = {"form", "button"}
+
+# ARIA roles of page chrome rather than content
+REMOVED_ROLES = {"banner", "navigation", "contentinfo", "complementary", "dialog"}
+
+# Class and id names of ad slots, cookie banners, share bars and other boilerplate.
+# A class token is boilerplate if it's one of these names, on its own or followed by
+# one of BOILERPLATE_SUFFIXES, e.g. "sidebar" or "cookie-banner" but not "has-sidebar"
+# or "share-enabled".
+BOILERPLATE_NAMES = {
+    "ad",
+    "ads",
+    "adslot",
+    "advert",
+    "advertisement",
+    "sponsored",
+    "promo",
+    "banner",
+    "cookie",
+    "cookies",
+    "consent",
+    "newsletter",
+    "subscribe",
+    "social",
+    "share",
+    "sharing",
+    "related",
+    "recommended",
+    "comment",
+    "comments",
+    "sidebar",
+    "popup",
+    "modal",
+    "breadcrumb",
+    "breadcrumbs",
+    "site-header",
+    "site-footer",
+    "menu",
+}
+
+# Endings of class names that make a boilerplate name a container of that boilerplate
+BOILERPLATE_SUFFIXES = {
+    "area",
+    "banner",
+    "bar",
+    "block",
+    "box",
+    "buttons",
+    "container",
+    "links",
+    "list",
+    "module",
+    "posts",
+    "section",
+    "signup",
+    "slot",
+    "unit",
+    "widget",
+    "wrapper",
+}
+
+NAME_SEPARATOR_PATTERN = re.compile(r"[-_]+")
+
+# Elements that can hold the main content and so are never dropped as boilerplate
+CONTENT_TAGS = {"html", "body", "main", "article"}
+
+PRICE_PATTERN = re.compile(r"\$\s?(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d{2})?")
+
+# Charsets declared by a Content-Type header, or by a page's <meta> tag
+CHARSET_PATTERN = re.compile(r"""charset\s*=\s*["']?([\w.:-]+)""", re.IGNORECASE)
+META_CHARSET_PATTERN = re.compile(
+    rb"""<meta[^>]+charset\s*=\s*["']?([\w.:-]+)""", re.IGNORECASE
+)
+
+_parser = lxml_html.HTMLParser(encoding="utf-8", remove_comments=True)
+
+
+def decode_html(data, content_type=None):
+    """
+    Decodes a raw HTML body using the charset in its Content-Type header, else the one
+    in its <meta> tag, else UTF-8, falling back to Windows-1252.
+
+    Unlike requests' response.text, a text/html header without a charset doesn't mean
+    ISO-8859-1 here, since most such pages declare UTF-8 in a <meta> tag.
+    """
+    encodings = []
+    match = CHARSET_PATTERN.search(content_type or "")
+    if match:
+        encodings.append(match.group(1))
+    match = META_CHARSET_PATTERN.search(data[:4096])
+    if match:
+        encodings.append(match.group(1).decode("ascii"))
+    for encoding in encodings + ["utf-8", "cp1252"]:
+        try:
+            return data.decode(encoding)
+        except (LookupError, UnicodeDecodeError):
+            continue
+    return data.decode("utf-8", errors="replace")
+
+
+def _parse(html):
+    # lxml refuses str input that carries an XML encoding declaration, so always
+    # hand it UTF-8 bytes, decoding raw bodies by their declared charset first
+    if isinstance(html, bytes):
+        html = decode_html(html)
+    html = html.encode("utf-8", errors="replace")
+    try:
+        return lxml_html.document_fromstring(html, parser=_parser)
+    except (etree.ParserError, ValueError):
+        return None
+
+
+def _is_boilerplate_name(name):
+    parts = NAME_SEPARATOR_PATTERN.split(name.lower())
+    for length in range(1, len(parts) + 1):
+        if "-".join(parts[:length]) in BOILERPLATE_NAMES:
+            rest = parts[length:]
+            return not rest or (len(rest) == 1 and rest[0] in BOILERPLATE_SUFFIXES)
+    return False
+
+
+def _is_boilerplate(element):
+    if element.tag in CONTENT_TAGS or element.get("role") == "main":
+        return False
+    if element.get("role") in REMOVED_ROLES or element.get("aria-hidden") == "true":
+        return True
+    if element.tag in BOILERPLATE_TAGS:
+        return True
+    names = f"{element.get('class', '')} {element.get('id', '')}".split()
+    return any(_is_boilerplate_name(name) for name in names)
+
+
+def _holds_main_content(element, page_text_length):
+    # Layout wrappers can look like boilerplate, so nothing holding the marked up main
+    # content or most of the page's text is dropped
+    if element.xpath("boolean(.//main | .//article | .//*[@role='main'])"):
+        return True
+    return len(_text_of(element)) * 2 >= page_text_length
+
+
+def _drop_boilerplate(root):
+    page_text_length = len(_text_of(root))
+    # Walk the tree top-down so a dropped block's descendants are never visited
+    stack = [root]
+    while stack:
+        element = stack.pop()
+        for child in list(element):
+            if not isinstance(child.tag, str):
+                continue
+            if _is_boilerplate(child) and not _holds_main_content(
+                child, page_text_length
+            ):
+                child.drop_tree()
+            else:
+                stack.append(child)
+
+
+def _text_of(element):
+    return "\n".join(
+        text for text in (chunk.strip() for chunk in element.itertext()) if text
+    )
+
+
+def _find_main_content(root):
+    # Prefer the <main>/<article> block holding most of the page's text, falling back
+    # to the whole body for pages that don't mark up their main content
+    body = root.find("body")
+    body = root if body is None else body
+    body_text = _text_of(body)
+
+    best, best_text = body, body_text
+    candidates = root.xpath("//main | //article | //*[@role='main']")
+    for candidate in candidates:
+        text = _text_of(candidate)
+        if len(text) * 2 >= len(body_text) and (
+            best is body or len(text) > len(best_text)
+        ):
+            best, best_text = candidate, text
+    return best, best_text
+
+
+def _product_name_near(anchor, anchor_text):
+    # Buy buttons like "$199 at Amazon" don't name the product, so fall back to the
+    # heading of the section the button sits in
+    if not is_generic_anchor_text(anchor_text):
+        return clean_product_name(anchor_text)
+    headings = anchor.xpath(
+        "preceding::*[self::h1 or self::h2 or self::h3 or self::h4][1]"
+    )
+    if not headings:
+        return ""
+    return clean_product_name(headings[0].text_content())
+
+
+def extract_page(html, url):
+    """
+    Extracts the main text, links and prices of an HTML page in a single parse.
+
+    Scripts, page chrome (headers, footers, navigation, sidebars) and boilerplate such
+    as ad slots and cookie banners are dropped before the text is read.
+
+    Args:
+        html (str or bytes): The HTML of the page, or its raw body to be decoded by
+            its <meta> charset.
+        url (str): The URL of the page, used to resolve relative links.
+
+    Returns:
+        dict: The page's "text", its "links" as [anchor text, absolute URL] pairs,
+            its "buy_links" to stores as [product name, absolute URL] pairs, the
+            "prices" mentioned in the text, and its "url".
+    """
+    page = {"text": "", "links": [], "buy_links": [], "prices": [], "url": url}
+    root = _parse(html)
+    if root is None:
+        return page
+
+    etree.strip_elements(root, *REMOVED_TAGS, with_tail=False)
+    _drop_boilerplate(root)
+
+    content, text = _find_main_content(root)
+
+    links = []
+    buy_links = []
+    seen = set()
+    for anchor in content.iter("a"):
+        href = anchor.get("href")
+        if not href:
+            continue
+        href = urljoin(url, href.strip())
+        if not href.startswith(("http://", "https://")) or href in seen:
+            continue
+        seen.add(href)
+        anchor_text = " ".join(anchor.text_content().split())
+        links.append([anchor_text, href])
+        if is_buy_link(href):
+            product_name = _product_name_near(anchor, anchor_text)
+            if product_name:
+                buy_links.append([product_name, href])
+
+    page["text"] = text
+    page["links"] = links
+    page["buy_links"] = buy_links
+    page["prices"] = list(dict.fromkeys(PRICE_PATTERN.findall(text)))
+    return page
+
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+
+def get_parse_pool():
+    """
+    Returns the process-wide pool of HTML parsing workers, starting it on first use.
+    """
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            # Spawn rather than fork, since the app process is full of threads
+            _parse_pool = ProcessPoolExecutor(
+                max_workers=PARSE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _parse_pool
+
+
+def _reset_parse_pool(broken_pool):
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is broken_pool:
+            _parse_pool = None
+
+
+async def extract_page_async(html, url):
+    """
+    Runs extract_page() on the parsing process pool, so CPU-bound parsing neither holds
+    the GIL nor stalls the event loop. Only the compact extracted page comes back.
+    """
+    loop = asyncio.get_running_loop()
+    pool = get_parse_pool()
+    try:
+        return await loop.run_in_executor(pool, extract_page, html, url)
+    except BrokenProcessPool:
+        dprint(f"HTML parsing pool broke while parsing {url}, restarting it...")
+        _reset_parse_pool(pool)
+        return await loop.run_in_executor(None, extract_page, html, url)
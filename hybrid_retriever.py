@@ -0,0 +1,132 @@
+import re
+
+import numpy as np
+
+from llama_index.core import Settings
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import MetadataMode, NodeWithScore
+
+# BM25 term frequency saturation and document length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Rank offset used by reciprocal rank fusion when merging the BM25 and vector rankings
+RRF_K = 60
+
+# Words, prices and model numbers like "wh-1000xm5", which are also indexed joined up so
+# "WH1000XM5" matches too
+TOKEN_PATTERN = re.compile(
+    r"\$\d+(?:[.,]\d+)*|\d+(?:[.,]\d+)+|[a-z0-9]+(?:-[a-z0-9]+)*"
+)
+
+
+def tokenize(text):
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        tokens.append(token.replace(",", ""))
+        if "-" in token:
+            tokens.append(token.replace("-", ""))
+            tokens.extend(token.split("-"))
+    return tokens
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Retrieves chunks by fusing a BM25 ranking with a cosine similarity ranking.
+
+    Per-search corpora hold a few hundred chunks, so both are scored brute force with
+    NumPy over contiguous matrices rather than through an index. BM25 catches the
+    product names, model numbers and prices that embeddings match poorly.
+    """
+
+    def __init__(self, nodes, similarity_top_k=2, **kwargs):
+        super().__init__(**kwargs)
+        self.nodes = [node for node in nodes if node.embedding is not None]
+        self.similarity_top_k = similarity_top_k
+
+        # Unit-length chunk embeddings, so cosine similarity is a single matrix product
+        embeddings = np.array(
+            [node.embedding for node in self.nodes], dtype=np.float32, ndmin=2
+        )
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        self.embeddings = np.ascontiguousarray(embeddings / np.maximum(norms, 1e-12))
+
+        # Term frequency matrix of chunks by vocabulary, and the BM25 weights
+        self.vocabulary = {}
+        rows, columns = [], []
+        lengths = []
+        for row, node in enumerate(self.nodes):
+            tokens = tokenize(node.get_content(metadata_mode=MetadataMode.NONE))
+            lengths.append(len(tokens))
+            for token in tokens:
+                rows.append(row)
+                columns.append(self.vocabulary.setdefault(token, len(self.vocabulary)))
+        term_frequencies = np.zeros(
+            (len(self.nodes), len(self.vocabulary)), dtype=np.float32
+        )
+        np.add.at(term_frequencies, (rows, columns), 1)
+
+        lengths = np.array(lengths, dtype=np.float32)
+        average_length = lengths.mean() if len(lengths) else 0.0
+        document_frequencies = (term_frequencies > 0).sum(axis=0)
+        self.idf = np.log(
+            1
+            + (len(self.nodes) - document_frequencies + 0.5)
+            / (document_frequencies + 0.5)
+        ).astype(np.float32)
+        length_norm = BM25_K1 * (
+            1 - BM25_B + BM25_B * lengths / max(average_length, 1e-12)
+        )
+        self.term_weights = np.ascontiguousarray(
+            term_frequencies * (BM25_K1 + 1) / (term_frequencies + length_norm[:, None])
+        )
+
+    def bm25_scores(self, query):
+        columns = [
+            self.vocabulary[token]
+            for token in set(tokenize(query))
+            if token in self.vocabulary
+        ]
+        if not columns:
+            return np.zeros(len(self.nodes), dtype=np.float32)
+        return self.term_weights[:, columns] @ self.idf[columns]
+
+    def cosine_scores(self, query_embedding):
+        query = np.asarray(query_embedding, dtype=np.float32)
+        return self.embeddings @ (query / max(np.linalg.norm(query), 1e-12))
+
+    def fuse(self, query, query_embedding):
+        """
+        Returns the top chunks by the reciprocal rank fusion of both rankings.
+        """
+        if not self.nodes:
+            return []
+        fused = np.zeros(len(self.nodes), dtype=np.float32)
+        for scores in (self.bm25_scores(query), self.cosine_scores(query_embedding)):
+            ranks = np.empty(len(scores), dtype=np.float32)
+            ranks[np.argsort(-scores, kind="stable")] = np.arange(1, len(scores) + 1)
+            fused += 1 / (RRF_K + ranks)
+        top = np.argsort(-fused, kind="stable")[: self.similarity_top_k]
+        return [NodeWithScore(node=self.nodes[i], score=float(fused[i])) for i in top]
+
+    def _query_text(self, query_bundle):
+        # Match against the user's request rather than the prompt template around it
+        return " ".join(query_bundle.embedding_strs)
+
+    def _retrieve(self, query_bundle):
+        if not self.nodes:
+            return []
+        query = self._query_text(query_bundle)
+        embedding = query_bundle.embedding or Settings.embed_model.get_query_embedding(
+            query
+        )
+        return self.fuse(query, embedding)
+
+    async def _aretrieve(self, query_bundle):
+        if not self.nodes:
+            return []
+        query = self._query_text(query_bundle)
+        embedding = query_bundle.embedding or (
+            await Settings.embed_model.aget_query_embedding(query)
+        )
+        return self.fuse(query, embedding)
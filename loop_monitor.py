@@ -0,0 +1,61 @@
+import asyncio
+import time
+
+import numpy as np
+
+# Seconds between event loop lag probes
+LAG_PROBE_INTERVAL = 0.05
+
+# Number of recent probes the lag percentiles are computed over
+LAG_WINDOW = 2000
+
+
+class LoopLagMonitor:
+    """
+    Measures event loop lag: how much later than scheduled a sleeping task wakes up.
+    Any blocking call on the loop shows up as lag for every other chat session.
+    """
+
+    def __init__(self, interval=LAG_PROBE_INTERVAL, window=LAG_WINDOW):
+        self.interval = interval
+        self.window = window
+        self.lags = []
+        self.max_lag = 0.0
+        self._task = None
+
+    def start(self):
+        # Start probing on the running loop, unless already probing it
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._probe())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _probe(self):
+        while True:
+            scheduled_at = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - scheduled_at)
+            self.lags.append(lag)
+            if len(self.lags) > self.window:
+                del self.lags[: len(self.lags) - self.window]
+            self.max_lag = max(self.max_lag, lag)
+
+    def metrics(self):
+        if not self.lags:
+            return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+        p50, p95, p99 = np.percentile(self.lags, [50, 95, 99])
+        return {"p50": p50, "p95": p95, "p99": p99, "max": self.max_lag}
+
+    def report(self):
+        metrics = self.metrics()
+        return (
+            f"event loop lag p50 {metrics['p50'] * 1000:.1f}ms, "
+            f"p95 {metrics['p95'] * 1000:.1f}ms, p99 {metrics['p99'] * 1000:.1f}ms, "
+            f"max {metrics['max'] * 1000:.1f}ms"
+        )
+
+
+loop_lag_monitor = LoopLagMonitor()
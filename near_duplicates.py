@@ -0,0 +1,102 @@
+import hashlib
+import re
+import zlib
+
+import numpy as np
+
+# Number of MinHash permutations, split into LSH bands of rows. Chunks sharing every row
+# of any band become candidates; with 8 bands of 8 rows, chunks about 77% similar
+# have even odds of sharing a band.
+NUM_PERMUTATIONS = 64
+LSH_BANDS = 8
+LSH_ROWS = NUM_PERMUTATIONS // LSH_BANDS
+
+# Estimated Jaccard similarity of word shingles above which chunks are near-duplicates
+NEAR_DUPLICATE_THRESHOLD = 0.8
+
+# Words per shingle
+SHINGLE_SIZE = 5
+
+# A Mersenne prime above every 32-bit shingle hash, and fixed permutations so that
+# signatures stay comparable across runs
+MERSENNE_PRIME = (1 << 61) - 1
+_random = np.random.default_rng(2024)
+_PERMUTATION_A = _random.integers(1, 1 << 31, NUM_PERMUTATIONS, dtype=np.uint64)
+_PERMUTATION_B = _random.integers(0, 1 << 31, NUM_PERMUTATIONS, dtype=np.uint64)
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def shingles(text):
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {" ".join(words)}
+    return {
+        " ".join(words[i : i + SHINGLE_SIZE])
+        for i in range(len(words) - SHINGLE_SIZE + 1)
+    }
+
+
+def minhash(text):
+    """
+    Returns the MinHash signature of the text's word shingles.
+    """
+    hashes = np.array(
+        [zlib.crc32(shingle.encode("utf-8")) for shingle in shingles(text)],
+        dtype=np.uint64,
+    )
+    # a * hash + b stays below 2^64, since a and b are below 2^31 and hash below 2^32
+    permuted = (np.outer(hashes, _PERMUTATION_A) + _PERMUTATION_B) % MERSENNE_PRIME
+    return permuted.min(axis=0).astype(np.uint32)
+
+
+def similarity(signature, other):
+    """
+    Estimates the Jaccard similarity of two texts from their signatures.
+    """
+    return float(np.mean(signature == other))
+
+
+def band_keys(signature):
+    """
+    Returns the LSH bucket of each band of the signature, as integers that fit SQLite.
+    """
+    return [
+        int.from_bytes(
+            hashlib.blake2b(
+                bytes([band])
+                + signature[band * LSH_ROWS : (band + 1) * LSH_ROWS].tobytes(),
+                digest_size=7,
+            ).digest(),
+            "big",
+        )
+        for band in range(LSH_BANDS)
+    ]
+
+
+class LSHIndex:
+    """
+    An in-memory LSH index of signatures, finding near-duplicates of a chunk without
+    comparing it to every other chunk.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.signatures = {}
+
+    def find(self, signature, threshold=NEAR_DUPLICATE_THRESHOLD):
+        """
+        Returns the key of an indexed near-duplicate of the signature, or None.
+        """
+        candidates = set()
+        for band_key in band_keys(signature):
+            candidates.update(self.buckets.get(band_key, ()))
+        for key in candidates:
+            if similarity(signature, self.signatures[key]) >= threshold:
+                return key
+        return None
+
+    def add(self, key, signature):
+        self.signatures[key] = signature
+        for band_key in band_keys(signature):
+            self.buckets.setdefault(band_key, []).append(key)
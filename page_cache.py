@@ -0,0 +1,209 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from helpers import canonicalize_url, dprint, get_domain
+
+PAGE_CACHE_PATH = os.getenv("PAGE_CACHE_PATH", "page_cache.db")
+
+# Upper bound on the compressed size of all cached pages, in bytes
+PAGE_CACHE_MAX_BYTES = int(os.getenv("PAGE_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+
+# Seconds a cached page stays fresh unless its domain has its own TTL
+DEFAULT_TTL = 24 * 60 * 60
+
+# Seconds between writes of the pages' last access times, which reads only note in
+# memory so they don't write to the database
+ACCESS_FLUSH_INTERVAL = 60
+
+# Retailers and forums change faster than editorial reviews
+DOMAIN_TTLS = {
+    "amazon.com": 6 * 60 * 60,
+    "bestbuy.com": 6 * 60 * 60,
+    "walmart.com": 6 * 60 * 60,
+    "target.com": 6 * 60 * 60,
+    "reddit.com": 2 * 60 * 60,
+}
+
+
+class CachedPage:
+    """
+    A page read from the cache, along with the validators needed to revalidate it.
+    """
+
+    def __init__(self, page, etag, last_modified, fetched_at, ttl):
+        self.page = page
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at
+        self.ttl = ttl
+
+    @property
+    def fresh(self):
+        return time.time() - self.fetched_at < self.ttl
+
+    def conditional_headers(self):
+        """
+        Returns the HTTP headers that ask the server to reply 304 if the page hasn't changed.
+        """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+def get_validators(headers):
+    """
+    Pulls the ETag and Last-Modified validators out of HTTP response headers.
+    """
+    return {
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+    }
+
+
+class PageCache:
+    """
+    A persistent, size-bounded cache of extracted page content keyed by canonical URL.
+
+    Pages are stored zlib-compressed in SQLite. Each domain has its own TTL, stale pages
+    keep their ETag/Last-Modified validators so they can be revalidated, and the least
+    recently used pages are evicted once the cache grows past `max_bytes`.
+
+    Every method blocks on SQLite, so async callers run them in an executor.
+    """
+
+    def __init__(self, path=PAGE_CACHE_PATH, max_bytes=PAGE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._accessed = {}
+        self._last_flushed = time.time()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                data BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS pages_accessed_at ON pages (accessed_at)"
+        )
+        self._conn.commit()
+        (self._total_size,) = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM pages"
+        ).fetchone()
+
+    def ttl_for(self, url):
+        domain = get_domain(url)
+        for ttl_domain, ttl in DOMAIN_TTLS.items():
+            if domain == ttl_domain or domain.endswith("." + ttl_domain):
+                return ttl
+        return DEFAULT_TTL
+
+    def get(self, url):
+        """
+        Returns the cached page for the URL, fresh or stale, or None if it isn't cached.
+        """
+        key = canonicalize_url(url)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data, etag, last_modified, fetched_at FROM pages WHERE url = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            self._accessed[key] = now
+            if now - self._last_flushed >= ACCESS_FLUSH_INTERVAL:
+                self._flush_accessed(now)
+                self._conn.commit()
+
+        data, etag, last_modified, fetched_at = row
+        page = json.loads(zlib.decompress(data))
+        page["url"] = url
+        return CachedPage(page, etag, last_modified, fetched_at, self.ttl_for(url))
+
+    def put(self, url, page, etag=None, last_modified=None):
+        """
+        Stores the page's extracted content, replacing any older copy of the URL.
+        """
+        key = canonicalize_url(url)
+        content = {field: value for field, value in page.items() if field != "url"}
+        data = zlib.compress(json.dumps(content).encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size FROM pages WHERE url = ?", (key,)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, data, len(data), etag, last_modified, now, now),
+            )
+            self._accessed.pop(key, None)
+            self._total_size += len(data) - (row[0] if row is not None else 0)
+            if self._total_size > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def refresh(self, url):
+        """
+        Marks a stale page as fresh again after the server confirmed it hasn't changed.
+        """
+        now = time.time()
+        key = canonicalize_url(url)
+        with self._lock:
+            self._conn.execute(
+                "UPDATE pages SET fetched_at = ?, accessed_at = ? WHERE url = ?",
+                (now, now, key),
+            )
+            self._accessed.pop(key, None)
+            self._conn.commit()
+
+    def _flush_accessed(self, now):
+        # Write the access times noted by reads since the last flush
+        self._conn.executemany(
+            "UPDATE pages SET accessed_at = ? WHERE url = ?",
+            [(accessed_at, key) for key, accessed_at in self._accessed.items()],
+        )
+        self._accessed.clear()
+        self._last_flushed = now
+
+    def _evict(self):
+        # Drop the least recently used pages until the cache fits within max_bytes
+        self._flush_accessed(time.time())
+        evicted = 0
+        rows = self._conn.execute(
+            "SELECT url, size FROM pages ORDER BY accessed_at ASC"
+        ).fetchall()
+        for url, size in rows:
+            if self._total_size <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM pages WHERE url = ?", (url,))
+            self._total_size -= size
+            evicted += 1
+        dprint(f"Evicted {evicted} page(s) from the page cache")
+
+
+_page_cache = None
+_page_cache_lock = threading.Lock()
+
+
+def get_page_cache():
+    """
+    Returns the process-wide page cache, opening it on first use.
+    """
+    global _page_cache
+    with _page_cache_lock:
+        if _page_cache is None:
+            _page_cache = PageCache()
+        return _page_cache
@@ -0,0 +1,105 @@
+import threading
+import time
+
+from helpers import dprint, get_domain
+
+# Seconds between readiness checks while a page is rendering
+READY_POLL_INTERVAL = 0.1
+
+# Number of consecutive unchanged checks after which a page counts as rendered
+READY_STABLE_POLLS = 3
+
+# Maximum seconds to wait for any single page to finish rendering
+READY_MAX_WAIT = 5.0
+
+# Shortest cap used for a domain, however fast its pages have rendered before
+READY_MIN_WAIT = 1.0
+
+# Weight of the newest observation in each domain's moving average
+READY_SMOOTHING = 0.3
+
+# Returns the load state, the amount of visible text and the number of network
+# requests made so far. The page is ready once all three stop changing.
+READINESS_SCRIPT = """
+return [
+    document.readyState,
+    document.body ? document.body.innerText.length : 0,
+    performance.getEntriesByType("resource").length,
+];
+"""
+
+
+class DomainWaitTimes:
+    """
+    Learns how long pages on each domain take to render, from past fetches.
+    """
+
+    def __init__(self):
+        self._wait_times = {}
+        self._lock = threading.Lock()
+
+    def cap_for(self, domain):
+        """
+        Returns the maximum number of seconds to wait for a page on the domain.
+        """
+        with self._lock:
+            learned = self._wait_times.get(domain)
+        if learned is None:
+            return READY_MAX_WAIT
+        return min(READY_MAX_WAIT, max(READY_MIN_WAIT, learned * 2))
+
+    def record(self, domain, seconds):
+        with self._lock:
+            learned = self._wait_times.get(domain)
+            if learned is None:
+                self._wait_times[domain] = seconds
+            else:
+                self._wait_times[domain] = (
+                    READY_SMOOTHING * seconds + (1 - READY_SMOOTHING) * learned
+                )
+
+
+domain_wait_times = DomainWaitTimes()
+
+
+def wait_for_page_ready(driver, url, cancelled=None):
+    """
+    Waits until the page's load state, visible text and network requests stop changing,
+    or until the per-domain cap runs out.
+
+    Args:
+        driver: The WebDriver that has started loading the page.
+        url (str): The URL being loaded, used to look up the domain's learned wait time.
+        cancelled (threading.Event): Stops the wait early once set.
+
+    Returns:
+        float: The number of seconds spent waiting.
+    """
+    domain = get_domain(url)
+    cap = domain_wait_times.cap_for(domain)
+    start = time.monotonic()
+    last_state = None
+    stable_polls = 0
+
+    while True:
+        elapsed = time.monotonic() - start
+        if elapsed >= cap:
+            dprint(f"Page {url} was still changing after {cap:.1f}s, reading it anyway")
+            break
+        if cancelled is not None and cancelled.is_set():
+            # A cancelled wait says nothing about how long the domain needs
+            return elapsed
+
+        state = tuple(driver.execute_script(READINESS_SCRIPT))
+        if state == last_state and state[1] > 0:
+            stable_polls += 1
+        else:
+            stable_polls = 0
+        if stable_polls >= READY_STABLE_POLLS:
+            break
+
+        last_state = state
+        time.sleep(READY_POLL_INTERVAL)
+
+    domain_wait_times.record(domain, elapsed)
+    return elapsed
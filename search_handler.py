@@ -1,61 +1,376 @@
+import asyncio
 import os
+import re
 import requests
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import Enum
-from bs4 import BeautifulSoup
 from duckduckgo_search import DDGS
 from serpapi.google_search import GoogleSearch
-from helpers import dprint
+from async_web_reader import needs_browser
+from cassette import get_cassette
+from helpers import canonicalize_url, dprint
+from html_extractor import decode_html, extract_page
+from page_cache import get_page_cache, get_validators
 
 Provider = Enum("Provider", "Google DuckDuckGo")
 
+# Seconds search results are reused for the same normalized query
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "3600"))
+SEARCH_CACHE_MAX_ENTRIES = 1000
 
-def extract_page_content(url):
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/90.0.4430.93 Safari/537.36"
-    }
+# Words and years that don't change which pages a product search finds
+SEARCH_STOPWORDS = {"a", "an", "and", "for", "in", "is", "of", "on", "or", "the", "to"}
+YEAR_PATTERN = re.compile(r"^(19|20)\d{2}$")
+
+# Rank offset used by reciprocal rank fusion when merging providers' results
+RRF_K = 60
+
+PAGE_FETCH_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/90.0.4430.93 Safari/537.36"
+}
+
+# Seconds allowed to connect to a site, and to read a page from it
+PAGE_CONNECT_TIMEOUT = 5
+PAGE_FETCH_TIMEOUT = 10
+
+# Pages are truncated after this many bytes
+PAGE_MAX_BYTES = 3 * 1024 * 1024
+
+# Maximum number of pages fetched at once by search(fetch_docs=True)
+FETCH_DOCS_CONCURRENCY = 8
+
+_requests_session = None
+_requests_session_lock = threading.Lock()
+
+_search_cache = {}
+_search_in_flight = {}
+_search_lock = threading.Lock()
+
+
+def get_requests_session():
+    """
+    Returns the shared requests session, whose keep-alive connections are reused across
+    page fetches.
+    """
+    global _requests_session
+    with _requests_session_lock:
+        if _requests_session is None:
+            _requests_session = requests.Session()
+            _requests_session.headers.update(PAGE_FETCH_HEADERS)
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=FETCH_DOCS_CONCURRENCY * 2,
+                pool_maxsize=FETCH_DOCS_CONCURRENCY,
+            )
+            _requests_session.mount("http://", adapter)
+            _requests_session.mount("https://", adapter)
+        return _requests_session
+
+
+def read_capped_body(response, max_bytes=PAGE_MAX_BYTES, timeout=PAGE_FETCH_TIMEOUT):
+    """
+    Reads a streamed response body, stopping at max_bytes or after timeout seconds.
+    """
+    body = bytearray()
+    started_at = time.monotonic()
+    for chunk in response.iter_content(chunk_size=64 * 1024):
+        body.extend(chunk)
+        if len(body) >= max_bytes:
+            dprint(f"Truncated {response.url} at {max_bytes} bytes")
+            break
+        if time.monotonic() - started_at >= timeout:
+            dprint(f"Stopped reading {response.url} after {timeout}s")
+            break
+    return decode_html(bytes(body[:max_bytes]), response.headers.get("Content-Type"))
+
+
+def download_page(url, cached=None):
+    """
+    Fetches the raw page, revalidating the stale cached copy if there is one.
+
+    Returns:
+        tuple: The status, HTML and cache validators, or None if the fetch failed.
+    """
+    headers = cached.conditional_headers() if cached is not None else {}
     try:
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.text, "html.parser")
-            # Remove scripts, styles, and ads
-            for script in soup(["script", "style", "header", "footer", "nav", "aside"]):
-                script.decompose()
-
-            # Extract text
-            content = soup.get_text(separator="\n", strip=True)
-            return content
-        else:
-            print(f"Failed to retrieve {url}: {response.status_code}")
-            return ""
+        with get_requests_session().get(
+            url,
+            headers=headers,
+            timeout=(PAGE_CONNECT_TIMEOUT, PAGE_FETCH_TIMEOUT),
+            stream=True,
+        ) as response:
+            validators = get_validators(response.headers)
+            if response.status_code == 304 and cached is not None:
+                return response.status_code, None, validators
+            elif response.status_code == 200:
+                return response.status_code, read_capped_body(response), validators
+            else:
+                print(f"Failed to retrieve {url}: {response.status_code}")
+                return None
     except Exception as e:
         print(f"Error fetching {url}: {e}")
+        return None
+
+
+def extract_page_content(url):
+    # Recordings must hold every page, so the page cache is bypassed with a cassette
+    cassette = get_cassette()
+    page_cache = get_page_cache() if cassette is None else None
+    cached = page_cache.get(url) if page_cache is not None else None
+    if cached is not None and cached.fresh:
+        dprint(f"Using cached content for {url}")
+        return cached.page["text"]
+
+    if cassette is not None:
+        result = cassette.call("http_page", [url], lambda: download_page(url))
+    else:
+        result = download_page(url, cached)
+    if result is None:
         return ""
 
+    status, html, validators = result
+    if status == 304 and cached is not None:
+        page_cache.refresh(url)
+        return cached.page["text"]
+    # The browser reader's recordings also keep the status of failed fetches
+    if html is None:
+        return ""
 
-def search(search_query, provider=Provider.Google, fetch_docs=False, max_results=20):
-    results = None
+    # Extract the main text, dropping scripts, page chrome and ads
+    page = extract_page(html, url)
+    # Empty pages and bot walls aren't cached, so the next search tries again
+    if page_cache is not None and not needs_browser(html, page["text"]):
+        page_cache.put(url, page, **validators)
+    return page["text"]
+
+
+def fetch_pages(urls, max_workers=FETCH_DOCS_CONCURRENCY):
+    """
+    Fetches the pages concurrently over pooled keep-alive connections.
+
+    Args:
+        urls (list): The URLs to fetch.
+        max_workers (int): The maximum number of pages fetched at once.
+
+    Returns:
+        list: A {"url", "text"} dict for each page that yielded text, in the order of
+            the given URLs.
+    """
+
+    def fetch(url):
+        dprint(f"Fetching content from: {url}")
+        return {"url": url, "text": extract_page_content(url)}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pages = list(executor.map(fetch, urls))
+    return [page for page in pages if page["text"]]
+
+
+# Sentence punctuation stripped from the ends of a query's words
+QUERY_EDGE_PUNCTUATION = ".,;:!?\"'()[]{}"
+
+
+def normalize_query(search_query):
+    """
+    Reduces a search query to its significant words, ignoring case, whitespace,
+    stopwords and years, so rephrasings of the same search share a key. Word order and
+    characters like the "+" of "c++" or the "#" of "c#" are kept, since they change
+    what the search finds.
+    """
+    words = (
+        word.strip(QUERY_EDGE_PUNCTUATION) for word in search_query.lower().split()
+    )
+    return " ".join(
+        word
+        for word in words
+        if word and word not in SEARCH_STOPWORDS and not YEAR_PATTERN.match(word)
+    )
+
+
+def search_provider(search_query, provider=Provider.Google, max_results=20):
+    """
+    Searches the provider and returns the URLs of the results, recording or replaying
+    the search if a cassette is in use.
+    """
+    cassette = get_cassette()
+    if cassette is not None:
+        return cassette.call(
+            "search",
+            [provider.name, search_query, max_results],
+            lambda: _search_provider_live(search_query, provider, max_results),
+        )
+    return _search_provider_live(search_query, provider, max_results)
+
+
+def _search_provider_live(search_query, provider, max_results):
     if provider == Provider.DuckDuckGo:
         results = DDGS().text(search_query, max_results=max_results)
-        urls = [result["href"] for result in results]
-    else:
-        params = {
-            "api_key": os.getenv("SERP_API_KEY"),
-            "engine": "google",
-            "q": search_query,
-            "google_domain": "google.com",
-            "gl": "us",
-            "hl": "en",
-            "num": max_results,
-        }
-        results = GoogleSearch(params).get_dict()
-        urls = [result["link"] for result in results["organic_results"]]
+        return [result["href"] for result in results]
+
+    params = {
+        "api_key": os.getenv("SERP_API_KEY"),
+        "engine": "google",
+        "q": search_query,
+        "google_domain": "google.com",
+        "gl": "us",
+        "hl": "en",
+        "num": max_results,
+    }
+    results = GoogleSearch(params).get_dict()
+    return [result["link"] for result in results["organic_results"]]
+
+
+def _store_search_results(key, urls):
+    now = time.monotonic()
+    _search_cache[key] = (now + SEARCH_CACHE_TTL, urls)
+    if len(_search_cache) > SEARCH_CACHE_MAX_ENTRIES:
+        for expired_key in [
+            k for k, (expires_at, _) in _search_cache.items() if expires_at <= now
+        ]:
+            del _search_cache[expired_key]
+    while len(_search_cache) > SEARCH_CACHE_MAX_ENTRIES:
+        # Dicts keep insertion order, so the first key is the oldest entry
+        del _search_cache[next(iter(_search_cache))]
+
+
+def cached_search(search_query, provider=Provider.Google, max_results=20):
+    """
+    Returns the URLs for the search, reusing results for the same normalized query for
+    SEARCH_CACHE_TTL seconds. Identical searches made while one is already running wait
+    for its results instead of calling the provider again.
+    """
+    key = (normalize_query(search_query), provider, max_results)
+    with _search_lock:
+        entry = _search_cache.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            dprint(f"Using cached search results for {search_query}")
+            return list(entry[1])
+        in_flight = _search_in_flight.get(key)
+        if in_flight is None:
+            in_flight = _search_in_flight[key] = Future()
+            is_owner = True
+        else:
+            is_owner = False
+
+    if not is_owner:
+        dprint(f"Waiting for identical in-flight search for {search_query}")
+        return list(in_flight.result())
+
+    try:
+        urls = search_provider(search_query, provider, max_results)
+    except Exception as e:
+        with _search_lock:
+            del _search_in_flight[key]
+        in_flight.set_exception(e)
+        raise
+
+    with _search_lock:
+        if urls:
+            _store_search_results(key, urls)
+        del _search_in_flight[key]
+    in_flight.set_result(urls)
+    return list(urls)
+
+
+def merge_search_results(result_lists, k=RRF_K):
+    """
+    Merges ranked URL lists with reciprocal rank fusion, dropping URLs that are the same
+    page once canonicalized. The first spelling seen of each URL is kept.
+    """
+    scores = {}
+    first_seen = {}
+    for urls in result_lists:
+        for rank, url in enumerate(urls, start=1):
+            if not url.startswith(("http://", "https://")):
+                continue
+            key = canonicalize_url(url)
+            first_seen.setdefault(key, url)
+            scores[key] = scores.get(key, 0) + 1 / (k + rank)
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    return [first_seen[key] for key in ranked]
+
+
+async def async_search(
+    search_query,
+    providers=(Provider.Google, Provider.DuckDuckGo),
+    max_results=20,
+    hedge_after=None,
+    min_results=None,
+):
+    """
+    Searches several providers without blocking the event loop and merges their results.
+
+    Args:
+        search_query (str): The search query.
+        providers (tuple): The providers to query, in order of preference.
+        max_results (int): The maximum number of URLs to return.
+        hedge_after (float): If set, only the first provider is queried at first, and
+            the next one is only queried if no results came back within this many
+            seconds. Otherwise all providers are queried at once.
+        min_results (int): Return as soon as the merged results hold this many URLs,
+            without waiting for slower providers. Defaults to max_results.
+
+    Returns:
+        list: The merged, deduplicated URLs, best first.
+    """
+    min_results = max_results if min_results is None else min_results
+    queued = list(providers)
+    pending = {}
+    results = {}
+
+    def start_next():
+        provider = queued.pop(0)
+        task = asyncio.ensure_future(
+            asyncio.to_thread(cached_search, search_query, provider, max_results)
+        )
+        pending[task] = provider
+
+    start_next()
+    while queued and hedge_after is None:
+        start_next()
+
+    merged = []
+    try:
+        while pending:
+            done, _ = await asyncio.wait(
+                pending,
+                timeout=hedge_after if queued else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done:
+                dprint(f"Search is slow, hedging with {queued[0].name}...")
+                start_next()
+                continue
+
+            for task in done:
+                provider = pending.pop(task)
+                try:
+                    results[provider] = task.result()
+                except Exception as e:
+                    dprint(f"{provider.name} search for {search_query} failed: {e}")
+                    results[provider] = []
+
+            merged = merge_search_results(
+                [results[provider] for provider in providers if provider in results]
+            )
+            if len(merged) >= min_results:
+                break
+            # Not enough results yet, so don't wait for the hedge timer
+            if not pending and queued:
+                start_next()
+    finally:
+        # Abandoned searches still finish in their threads and fill the search cache
+        for task in pending:
+            task.cancel()
+
+    return merged[:max_results]
+
+
+def search(search_query, provider=Provider.Google, fetch_docs=False, max_results=20):
+    urls = cached_search(search_query, provider, max_results)
 
     if fetch_docs:
-        all_content = []
-        for url in urls:
-            dprint(f"Fetching content from: {url}")
-            page_content = extract_page_content(url)
-            all_content.append(page_content)
-        return set(all_content)
+        return fetch_pages(urls)
     else:
         return urls
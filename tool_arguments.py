@@ -0,0 +1,67 @@
+import json
+
+
+class StreamingArgumentParser:
+    """
+    Parses a tool call's JSON arguments as they stream in, so a top-level string
+    argument can be used as soon as its closing quote arrives, before the rest of the
+    arguments are done.
+
+    Only top-level string values are collected; nested objects, arrays and other values
+    are skipped over.
+    """
+
+    def __init__(self):
+        self.fields = {}
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._string = []
+        self._key = None
+        self._expecting_key = False
+
+    def feed(self, text):
+        """
+        Parses the next piece of the arguments.
+
+        Returns:
+            dict: The top-level string arguments completed so far.
+        """
+        for char in text:
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    self._end_string()
+                    continue
+                self._string.append(char)
+            elif char == '"':
+                self._in_string = True
+                self._string = []
+            elif char in "{[":
+                self._depth += 1
+                if self._depth == 1:
+                    self._expecting_key = char == "{"
+            elif char in "}]":
+                self._depth -= 1
+            elif self._depth == 1 and char == ":":
+                self._expecting_key = False
+            elif self._depth == 1 and char == ",":
+                self._expecting_key = True
+                self._key = None
+        return self.fields
+
+    def _end_string(self):
+        if self._depth != 1:
+            return
+        try:
+            value = json.loads('"' + "".join(self._string) + '"')
+        except ValueError:
+            return
+        if self._expecting_key:
+            self._key = value
+        elif self._key is not None:
+            self.fields[self._key] = value
@@ -0,0 +1,206 @@
+import atexit
+import json
+import os
+import threading
+import time
+
+from urllib.parse import urlsplit
+
+from helpers import canonicalize_url, dprint, get_domain
+
+DOMAIN_YIELD_FILE = os.getenv("DOMAIN_YIELD_FILE", "domain_yield.json")
+
+# Video, social and login-walled sites whose pages yield no usable review text
+USELESS_DOMAINS = {
+    "youtube.com",
+    "youtu.be",
+    "vimeo.com",
+    "tiktok.com",
+    "facebook.com",
+    "instagram.com",
+    "pinterest.com",
+    "twitter.com",
+    "x.com",
+    "linkedin.com",
+    "quora.com",
+}
+
+# Links to files rather than web pages
+USELESS_EXTENSIONS = (
+    ".pdf",
+    ".jpg",
+    ".jpeg",
+    ".png",
+    ".gif",
+    ".webp",
+    ".mp4",
+    ".mp3",
+    ".zip",
+    ".doc",
+    ".docx",
+    ".xls",
+    ".xlsx",
+    ".ppt",
+    ".pptx",
+)
+
+# A page with this much text counts as a full yield for its domain
+FULL_YIELD_TEXT_LENGTH = 3000
+
+# Yield assumed for domains that haven't been fetched yet
+DEFAULT_YIELD = 0.5
+
+# Weight of the newest fetch in each domain's moving average yield
+YIELD_SMOOTHING = 0.3
+
+# Domains are skipped once their yield has stayed below MIN_YIELD over MIN_SAMPLES fetches
+MIN_YIELD = 0.05
+MIN_SAMPLES = 5
+
+# Seconds after its last fetch that a skipped domain is tried again, so a site that
+# fixed itself or was only slow for a while gets a fresh sample
+DEAD_DOMAIN_RETRY_AFTER = int(os.getenv("DEAD_DOMAIN_RETRY_AFTER", str(24 * 60 * 60)))
+
+# Rank offset that keeps search rank and domain yield in balance when ranking URLs
+RANK_OFFSET = 10
+
+# Seconds between saves of the domain yields to disk
+SAVE_INTERVAL = 30
+
+
+def is_useless_url(url):
+    """
+    Returns whether the URL points at a file or a site that yields no review text.
+    """
+    domain = get_domain(url)
+    if any(
+        domain == useless or domain.endswith("." + useless)
+        for useless in USELESS_DOMAINS
+    ):
+        return True
+    return urlsplit(url).path.lower().endswith(USELESS_EXTENSIONS)
+
+
+class DomainYields:
+    """
+    Tracks how much usable text pages on each domain have yielded in past fetches,
+    persisted to a JSON file so it carries over between runs.
+    """
+
+    def __init__(self, path=DOMAIN_YIELD_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._last_saved = time.monotonic()
+        self._yields = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as file:
+                    self._yields = json.load(file)
+            except (OSError, ValueError) as e:
+                dprint(f"Couldn't load domain yields from {path}: {e}")
+
+    def score(self, domain):
+        with self._lock:
+            entry = self._yields.get(domain)
+        return DEFAULT_YIELD if entry is None else entry["yield"]
+
+    def is_dead(self, domain):
+        with self._lock:
+            entry = self._yields.get(domain)
+        # Yields saved before fetch times were recorded are due for a retry
+        return (
+            entry is not None
+            and entry["samples"] >= MIN_SAMPLES
+            and entry["yield"] < MIN_YIELD
+            and time.time() - entry.get("fetched_at", 0) < DEAD_DOMAIN_RETRY_AFTER
+        )
+
+    def record(self, url, page):
+        """
+        Records the outcome of fetching the URL; a failed fetch has no page. Fetches
+        that timed out or were refused say nothing about the domain's content and
+        aren't recorded. The domain is taken from the canonical URL, as in prepare_urls,
+        so mobile and AMP hosts share their site's entry.
+        """
+        domain = get_domain(canonicalize_url(url))
+        text_length = len(page["text"]) if page is not None else 0
+        sample = min(1.0, text_length / FULL_YIELD_TEXT_LENGTH)
+        with self._lock:
+            entry = self._yields.get(domain)
+            if entry is None:
+                entry = self._yields[domain] = {"yield": sample, "samples": 1}
+            else:
+                entry["yield"] = (
+                    YIELD_SMOOTHING * sample + (1 - YIELD_SMOOTHING) * entry["yield"]
+                )
+                entry["samples"] += 1
+            entry["fetched_at"] = time.time()
+            should_save = time.monotonic() - self._last_saved >= SAVE_INTERVAL
+        if should_save:
+            self.save()
+
+    def save(self):
+        with self._lock:
+            self._last_saved = time.monotonic()
+            data = json.dumps(self._yields, indent=4)
+        try:
+            with open(self.path, "w") as file:
+                file.write(data)
+        except OSError as e:
+            dprint(f"Couldn't save domain yields to {self.path}: {e}")
+
+
+_domain_yields = None
+_domain_yields_lock = threading.Lock()
+
+
+def get_domain_yields():
+    """
+    Returns the process-wide domain yield tracker, loading it from disk on first use.
+    """
+    global _domain_yields
+    with _domain_yields_lock:
+        if _domain_yields is None:
+            _domain_yields = DomainYields()
+            atexit.register(_domain_yields.save)
+        return _domain_yields
+
+
+def prepare_urls(urls, max_urls=None):
+    """
+    Turns raw search result links into the list of pages worth fetching.
+
+    Links are deduplicated by their canonical form (dropping tracking parameters and
+    collapsing AMP and mobile variants), keeping the first spelling seen, since the
+    canonical form isn't always a URL that exists. Files, video and social sites, and
+    domains that keep yielding no text are dropped. The rest are ranked by their search
+    rank weighted by their domain's historical content yield.
+
+    Args:
+        urls (list): The search result links, best first.
+        max_urls (int): Optional number of URLs to keep.
+
+    Returns:
+        list: The URLs to fetch, as the search returned them, best first.
+    """
+    domain_yields = get_domain_yields()
+    scores = {}
+    first_seen = {}
+    for rank, url in enumerate(urls, start=1):
+        if not url.startswith(("http://", "https://")) or is_useless_url(url):
+            dprint(f"Skipping {url}, it won't have any review text")
+            continue
+        canonical_url = canonicalize_url(url)
+        domain = get_domain(canonical_url)
+        if canonical_url in scores:
+            continue
+        if domain_yields.is_dead(domain):
+            dprint(f"Skipping {url}, {domain} hasn't yielded any text lately")
+            continue
+        first_seen[canonical_url] = url
+        scores[canonical_url] = (0.5 + domain_yields.score(domain)) / (
+            RANK_OFFSET + rank
+        )
+
+    ranked = [first_seen[key] for key in sorted(scores, key=scores.get, reverse=True)]
+    return ranked if max_urls is None else ranked[:max_urls]
@@ -0,0 +1,373 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from llama_index.core import Document, Settings, VectorStoreIndex
+from llama_index.core.schema import MetadataMode, TextNode
+from llama_index.core.utils import get_tokenizer
+
+from cassette import get_cassette
+from helpers import canonicalize_url, dprint
+from near_duplicates import (
+    NEAR_DUPLICATE_THRESHOLD,
+    LSHIndex,
+    band_keys,
+    minhash,
+    similarity,
+)
+
+VECTOR_STORE_PATH = os.getenv("VECTOR_STORE_PATH", "vector_store.db")
+
+# Seconds a page's chunks are kept after it was last used
+VECTOR_STORE_TTL = int(os.getenv("VECTOR_STORE_TTL", str(7 * 24 * 60 * 60)))
+
+# Seconds between sweeps for expired pages
+EVICT_INTERVAL = 10 * 60
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def get_embed_model_name():
+    return getattr(
+        Settings.embed_model, "model_name", type(Settings.embed_model).__name__
+    )
+
+
+class VectorStore:
+    """
+    A persistent store of embedded page chunks, shared across chat sessions.
+
+    Chunks are keyed by the page's canonical URL and the hash of its content, so a page is
+    only chunked and embedded again when its content or the embedding model changes.
+    Pages are kept in separate collections, e.g. review text and purchasing links, and
+    are evicted once they haven't been used for `ttl` seconds.
+
+    Review pages syndicate each other heavily, so each chunk's MinHash signature is
+    indexed by LSH band. A chunk that nearly duplicates one stored from another page
+    reuses its embedding instead of being embedded again, and near-duplicates are
+    collapsed into one chunk citing every page when a search's chunks are retrieved.
+    """
+
+    def __init__(self, path=VECTOR_STORE_PATH, ttl=VECTOR_STORE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._last_evicted = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._drop_outdated_tables()
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT NOT NULL,
+                collection TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                model TEXT NOT NULL,
+                used_at REAL NOT NULL,
+                PRIMARY KEY (url, collection)
+            )
+            """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS chunks (
+                id INTEGER PRIMARY KEY,
+                url TEXT NOT NULL,
+                collection TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                metadata TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                signature BLOB NOT NULL
+            )
+            """)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS chunks_url ON chunks (url, collection)"
+        )
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS bands (
+                collection TEXT NOT NULL,
+                band INTEGER NOT NULL,
+                chunk_id INTEGER NOT NULL
+            )
+            """)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS bands_band ON bands (collection, band)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS bands_chunk ON bands (chunk_id)")
+        self._conn.commit()
+
+    def _drop_outdated_tables(self):
+        # Stores written before chunks had signatures are rebuilt from scratch, since
+        # they're only a cache of embeddings
+        columns = [
+            row[1] for row in self._conn.execute("PRAGMA table_info(chunks)").fetchall()
+        ]
+        if columns and "signature" not in columns:
+            dprint("Rebuilding the vector store to index near-duplicate chunks")
+            self._conn.execute("DROP TABLE chunks")
+            self._conn.execute("DROP TABLE IF EXISTS pages")
+
+    def _find_duplicate_embeddings(self, key, collection, model, signatures):
+        # Returns the stored embeddings of chunks on other pages that nearly duplicate
+        # the given chunks, by chunk position
+        duplicates = {}
+        for position, signature in enumerate(signatures):
+            keys = band_keys(signature)
+            rows = self._conn.execute(
+                "SELECT DISTINCT chunks.id, chunks.signature, chunks.embedding "
+                "FROM bands JOIN chunks ON chunks.id = bands.chunk_id "
+                "JOIN pages ON pages.url = chunks.url "
+                "AND pages.collection = chunks.collection "
+                f"WHERE bands.collection = ? AND bands.band IN ({','.join('?' * len(keys))}) "
+                "AND chunks.url != ? AND pages.model = ?",
+                (collection, *keys, key, model),
+            ).fetchall()
+            for _, stored_signature, embedding in rows:
+                stored_signature = np.frombuffer(stored_signature, dtype=np.uint32)
+                if similarity(signature, stored_signature) >= NEAR_DUPLICATE_THRESHOLD:
+                    duplicates[position] = embedding
+                    break
+        return duplicates
+
+    def _delete_chunks(self, url, collection):
+        self._conn.execute(
+            "DELETE FROM bands WHERE chunk_id IN "
+            "(SELECT id FROM chunks WHERE url = ? AND collection = ?)",
+            (url, collection),
+        )
+        self._conn.execute(
+            "DELETE FROM chunks WHERE url = ? AND collection = ?", (url, collection)
+        )
+
+    def upsert(self, url, text, collection="pages"):
+        """
+        Chunks and embeds the page, unless the same content is already stored.
+
+        Args:
+            url (str): The page's URL, kept in each chunk's metadata.
+            text (str): The page's text.
+            collection (str): The collection the page belongs to.
+
+        Returns:
+            bool: Whether the page had to be embedded.
+        """
+        key = canonicalize_url(url)
+        digest = content_hash(text)
+        model = get_embed_model_name()
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content_hash, model FROM pages WHERE url = ? AND collection = ?",
+                (key, collection),
+            ).fetchone()
+            if row == (digest, model):
+                self._conn.execute(
+                    "UPDATE pages SET used_at = ? WHERE url = ? AND collection = ?",
+                    (now, key, collection),
+                )
+                self._conn.commit()
+                return False
+
+        # Chunk and embed outside the lock, so other sessions can keep reading
+        document = Document(text=text, metadata={"url": url})
+        nodes = Settings.node_parser.get_nodes_from_documents([document])
+        signatures = [minhash(node.get_content()) for node in nodes]
+        with self._lock:
+            embeddings = self._find_duplicate_embeddings(
+                key, collection, model, signatures
+            )
+        if embeddings:
+            tokenizer = get_tokenizer()
+            dedup_stats.record(
+                len(embeddings),
+                sum(
+                    len(tokenizer(nodes[position].get_content()))
+                    for position in embeddings
+                ),
+            )
+
+        missing = [
+            position for position in range(len(nodes)) if position not in embeddings
+        ]
+        new_embeddings = Settings.embed_model.get_text_embedding_batch(
+            [
+                nodes[position].get_content(metadata_mode=MetadataMode.EMBED)
+                for position in missing
+            ]
+        )
+        for position, embedding in zip(missing, new_embeddings):
+            embeddings[position] = np.asarray(embedding, dtype=np.float32).tobytes()
+
+        with self._lock:
+            self._delete_chunks(key, collection)
+            for position, (node, signature) in enumerate(zip(nodes, signatures)):
+                chunk_id = self._conn.execute(
+                    "INSERT INTO chunks (url, collection, position, text, metadata, "
+                    "embedding, signature) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        key,
+                        collection,
+                        position,
+                        node.get_content(),
+                        json.dumps(node.metadata),
+                        embeddings[position],
+                        signature.tobytes(),
+                    ),
+                ).lastrowid
+                self._conn.executemany(
+                    "INSERT INTO bands VALUES (?, ?, ?)",
+                    [(collection, band, chunk_id) for band in band_keys(signature)],
+                )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)",
+                (key, collection, digest, model, now),
+            )
+            if now - self._last_evicted >= EVICT_INTERVAL:
+                self._evict(now)
+            self._conn.commit()
+        dprint(
+            f"Embedded {len(missing)} chunk(s) from {url}, reused "
+            f"{len(nodes) - len(missing)} near-duplicate embedding(s)"
+        )
+        return True
+
+    def content_hashes(self, urls, collection="pages"):
+        """
+        Returns the content hash of each given page the store holds, by URL.
+        """
+        hashes = {}
+        with self._lock:
+            for url in urls:
+                row = self._conn.execute(
+                    "SELECT content_hash FROM pages WHERE url = ? AND collection = ?",
+                    (canonicalize_url(url), collection),
+                ).fetchone()
+                if row is not None:
+                    hashes[url] = row[0]
+        return hashes
+
+    def get_nodes(self, urls, collection="pages"):
+        """
+        Returns the stored chunks of the given pages as nodes carrying their embeddings.
+
+        Near-duplicate chunks are collapsed into the copy from the earliest page given,
+        whose "urls" metadata lists every page the chunk appeared on.
+
+        Args:
+            urls (list): The pages to retrieve from, best first, e.g. the current
+                search's results.
+            collection (str): The collection the pages belong to.
+        """
+        nodes = []
+        lsh_index = LSHIndex()
+        duplicate_tokens = 0
+        tokenizer = get_tokenizer()
+        with self._lock:
+            for url in urls:
+                rows = self._conn.execute(
+                    "SELECT text, metadata, embedding, signature FROM chunks "
+                    "WHERE url = ? AND collection = ? ORDER BY position",
+                    (canonicalize_url(url), collection),
+                ).fetchall()
+                for text, metadata, embedding, signature in rows:
+                    signature = np.frombuffer(signature, dtype=np.uint32)
+                    duplicate_of = lsh_index.find(signature)
+                    if duplicate_of is not None:
+                        sources = nodes[duplicate_of].metadata["urls"]
+                        if url not in sources:
+                            sources.append(url)
+                        duplicate_tokens += len(tokenizer(text))
+                        continue
+                    lsh_index.add(len(nodes), signature)
+                    nodes.append(
+                        TextNode(
+                            text=text,
+                            metadata={
+                                **json.loads(metadata),
+                                "url": url,
+                                "urls": [url],
+                            },
+                            excluded_llm_metadata_keys=["urls"],
+                            excluded_embed_metadata_keys=["urls"],
+                            embedding=np.frombuffer(
+                                embedding, dtype=np.float32
+                            ).tolist(),
+                        )
+                    )
+        if duplicate_tokens:
+            dedup_stats.record_collapsed(duplicate_tokens)
+        return nodes
+
+    def as_index(self, urls, collection="pages"):
+        """
+        Builds an in-memory VectorStoreIndex over the stored chunks of the given pages,
+        reusing their stored embeddings.
+        """
+        return VectorStoreIndex(self.get_nodes(urls, collection))
+
+    def _evict(self, now):
+        # Drop the pages, and their chunks, that haven't been used within the TTL
+        self._last_evicted = now
+        expired = self._conn.execute(
+            "SELECT url, collection FROM pages WHERE used_at < ?", (now - self.ttl,)
+        ).fetchall()
+        for url, collection in expired:
+            self._delete_chunks(url, collection)
+            self._conn.execute(
+                "DELETE FROM pages WHERE url = ? AND collection = ?", (url, collection)
+            )
+        if expired:
+            dprint(f"Evicted {len(expired)} page(s) from the vector store")
+
+
+class DedupStats:
+    """
+    Counts the tokens near-duplicate chunks would have cost.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reused_chunks = 0
+        self.embedding_tokens_saved = 0
+        self.context_tokens_saved = 0
+
+    def record(self, reused_chunks, tokens):
+        with self._lock:
+            self.reused_chunks += reused_chunks
+            self.embedding_tokens_saved += tokens
+
+    def record_collapsed(self, tokens):
+        with self._lock:
+            self.context_tokens_saved += tokens
+
+    def report(self):
+        with self._lock:
+            return (
+                f"{self.reused_chunks} near-duplicate chunk(s) not embedded, saving "
+                f"{self.embedding_tokens_saved} embedding token(s); "
+                f"{self.context_tokens_saved} duplicate token(s) collapsed at retrieval"
+            )
+
+
+dedup_stats = DedupStats()
+
+_vector_store = None
+_vector_store_lock = threading.Lock()
+
+
+def get_vector_store():
+    """
+    Returns the process-wide vector store, opening it on first use.
+
+    With a cassette the store is kept in memory, starting empty on every run, so the
+    pages embedded don't depend on what this machine stored before.
+    """
+    global _vector_store
+    with _vector_store_lock:
+        if _vector_store is None:
+            path = ":memory:" if get_cassette() is not None else VECTOR_STORE_PATH
+            _vector_store = VectorStore(path=path)
+        return _vector_store